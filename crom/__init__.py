@@ -1,7 +1,7 @@
 from zope.interface import Interface
 from zope.interface.interfaces import ComponentLookupError
 
-from .registry import Registry
+from .registry import Registry, MultiMapRegistry, FrozenRegistry
 from .lookup import ListLookup, ChainLookup
 
 from .directives import sources, target, name, implements
@@ -11,7 +11,10 @@ from .implicit import implicit
 
 from .config import grok, configure
 
-from .mapping import MapKey, Map, MultiMap
+from .mapping import (MapKey, Map, MultiMap, FlatMultiMap, FrozenMultiMap,
+                      ConcurrentMultiMap, MapKeyIndex, IndexedMap,
+                      LookupStats, InstrumentedMap, InstrumentedMultiMap,
+                      WeakMap, WeakMultiMap)
 
 # we do the absolutely compatible monkey patches , not breaking
 # the __call__ behavior of interface in any possible way as we don't touch it
@@ -21,7 +24,8 @@ from . import monkey
 monkey.safe()
 
 __all__ = ["Interface", "ComponentLookupError",
-           "Registry", "ListLookup", "ChainLookup",
+           "Registry", "MultiMapRegistry", "FrozenRegistry",
+           "ListLookup", "ChainLookup",
            "sources", "target", "name", "registry", "implements",
            "component", "adapter",
            "implicit", "grok", "configure"]
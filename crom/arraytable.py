@@ -0,0 +1,112 @@
+"""
+Vectorized lookups in a MultiMap using NumPy.
+
+This is optional and needs NumPy to be installed.
+
+An ArrayTable is compiled from the entries of a MultiMap of a single
+arity, with the MapKeys encoded as integers by a MapKeyIndex. It can
+then resolve whole columns of integer-encoded MultiMapKeys in one go,
+which is useful when looking up the same kind of thing for millions of
+rows of data.
+"""
+import numpy
+
+class ArrayTable(object):
+    """A compiled, vectorized version of the entries in a MultiMap.
+
+    The rank matrix has a row for each MapKey in the index, and a
+    column for each MapKey in the index. It holds the position of the
+    column MapKey in the linearization of the row MapKey, or a
+    position past the end if it is not an ancestor. The entries array
+    has a row for each entry of the MultiMap, with the ids of its
+    components. With these the value for every combination of ids is
+    worked out in advance, and stored in ``table``, which has a
+    dimension for each position.
+
+    ``values`` lists the values of the MultiMap; lookups return
+    indexes into it.
+
+    ``table`` has (number of MapKeys in the index) ** arity elements,
+    so this is meant for small collections of MapKeys. The ArrayTable
+    does not change when the MultiMap or the index changes; create a
+    new one instead.
+    """
+    def __init__(self, multimap, index, arity):
+        if arity < 1:
+            raise ValueError("An ArrayTable needs an arity of at least 1.")
+        self.index = index
+        self.arity = arity
+        entries = [(key, value) for key, value in multimap._exact.items()
+                   if len(key) == arity]
+        for key, value in entries:
+            for mapkey in key:
+                index.add(mapkey)
+        size = len(index)
+        # any rank of this or higher means that the MapKey is not an
+        # ancestor at all
+        self._no_rank = size
+        ranks = numpy.full((size, size), size, dtype=numpy.int32)
+        for key_id in range(size):
+            for position, ancestor in enumerate(
+                    index.mapkey(key_id)._parent_mapkeys):
+                ranks[key_id, index.id(ancestor)] = position
+        self.ranks = ranks
+        self.values = []
+        value_numbers = {}
+        self.entries = numpy.zeros((len(entries), arity), dtype=numpy.int64)
+        self.entry_values = numpy.zeros(len(entries), dtype=numpy.int64)
+        for i, (key, value) in enumerate(entries):
+            self.entries[i] = [index.id(mapkey) for mapkey in key]
+            number = value_numbers.get(id(value))
+            if number is None:
+                number = value_numbers[id(value)] = len(self.values)
+                self.values.append(value)
+            self.entry_values[i] = number
+        # the value index for every combination of ids, so that
+        # lookups are a matter of indexing
+        shape = (size,) * arity
+        combinations = numpy.indices(shape).reshape(arity, -1)
+        self.table = self._resolve(combinations).reshape(shape)
+
+    def lookup_array(self, ids_per_position):
+        """Look up a column of integer-encoded MultiMapKeys.
+
+        ids_per_position is a sequence with an array of MapKey ids for
+        each position, all of the same length. Returns an array with
+        the index into ``values`` of the value found for each row, or
+        -1 if no value could be found.
+        """
+        if len(ids_per_position) != self.arity:
+            raise ValueError("Expected ids for %s positions, got %s." %
+                             (self.arity, len(ids_per_position)))
+        return self.table[tuple(numpy.asarray(ids, dtype=numpy.intp)
+                                for ids in ids_per_position)]
+
+    def _resolve(self, ids_per_position, chunk_size=4096):
+        # find the value index for each row of ids by comparing it
+        # with all entries at once. This is done chunk_size rows at a
+        # time, which limits the memory used to chunk_size times the
+        # number of entries
+        rows = len(ids_per_position[0])
+        result = numpy.full(rows, -1, dtype=numpy.int32)
+        if not len(self.entries):
+            return result
+        # the ranks of all positions are combined into one score, the
+        # first position counting most
+        base = self._no_rank + 1
+        for start in range(0, rows, chunk_size):
+            end = min(start + chunk_size, rows)
+            score = numpy.zeros((end - start, len(self.entries)),
+                                dtype=numpy.int64)
+            valid = numpy.ones(score.shape, dtype=bool)
+            for position, ids in enumerate(ids_per_position):
+                rank = self.ranks[ids[start:end, None],
+                                  self.entries[None, :, position]]
+                valid &= rank < self._no_rank
+                score *= base
+                score += rank
+            score[~valid] = numpy.iinfo(numpy.int64).max
+            best = score.argmin(axis=1)
+            found = valid[numpy.arange(end - start), best]
+            result[start:end][found] = self.entry_values[best[found]]
+        return result
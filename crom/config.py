@@ -1,5 +1,5 @@
 import venusian
-from zope.configuration.config import ConfigurationMachine
+from zope.configuration.config import ConfigurationMachine, ConfigurationError
 
 def grok(package, config):
     scanner = venusian.Scanner(config=config)
@@ -8,6 +8,41 @@ def grok(package, config):
 def configure(package):
     config = ConfigurationMachine()
     grok(package, config)
+    config.crom_registrations = []
     config.execute_actions()
+    _register_all(config.crom_registrations)
+
+def _register_all(registrations):
+    """Register a list of (registry, registration) pairs.
+
+    The registrations for each registry are made with a single call to
+    its register_many, in the order in which they were listed.
+    """
+    by_registry = {}
+    order = []
+    for registry, registration in registrations:
+        found = by_registry.get(id(registry))
+        if found is None:
+            found = by_registry[id(registry)] = (registry, [])
+            order.append(found)
+        found[1].append(registration)
+    for registry, registry_registrations in order:
+        try:
+            registry.register_many(registry_registrations)
+        except Exception as e:
+            # find out which registration is at fault to report it
+            _register_one_by_one(registry, registry_registrations)
+            raise e
+
+def _register_one_by_one(registry, registrations):
+    for sources, target, name, component in registrations:
+        try:
+            registry.register(sources, target, name, component)
+        except Exception as e:
+            raise ConfigurationError(
+                "Could not register %r for sources %r, target %r "
+                "and name %r with %r: %s: %s" %
+                (component, sources, target, name, registry,
+                 e.__class__.__name__, e))
     
     
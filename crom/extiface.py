@@ -1,3 +1,4 @@
+from itertools import tee
 from zope.interface.interfaces import ComponentLookupError
 from .implicit import implicit
 from .interfaces import NoImplicitLookupError
@@ -45,3 +46,34 @@ def adapter_lookup(iface, *args, **kw):
     return do_lookup(
         iface, find_lookup(kw).adapt, 'adapter', *args, **kw)
 
+def adapter_many_lookup(iface, obs, **kw):
+    """Adapt each object in obs to iface.
+
+    Returns a list of the adapted objects, in the same order. With
+    ``stream=True`` an iterator is returned instead, which adapts the
+    objects as it is consumed.
+    """
+    lookup = find_lookup(kw)
+    name = kw.pop('name', '')
+    default = kw.pop('default', SENTINEL)
+    stream = kw.pop('stream', False)
+    if kw:
+        raise TypeError("Illegal extra keyword arguments: %s" %
+                        ', '.join(kw.keys()))
+    results = do_adapt_many(iface, lookup, obs, name, default)
+    if stream:
+        return results
+    return list(results)
+
+def do_adapt_many(iface, lookup, obs, name, default):
+    obs, sources = tee(obs)
+    for adapted in lookup.adapt_many(obs, iface, name):
+        ob = next(sources)
+        if adapted is not None:
+            yield adapted
+        elif default is not SENTINEL:
+            yield default
+        else:
+            raise ComponentLookupError(
+                "Could not find adapter from sources %s to target %s." %
+                ((ob,), iface))
@@ -18,17 +18,29 @@ def registry_converter(registry):
 # this needs to be defined here to avoid circular imports
 registry = Directive('registry', 'crom', converter=registry_converter)
 
+def register_action(config, registry, sources, target, name, obj):
+    """Add an action to config that registers obj with registry.
+
+    crom.configure collects the registrations made by these actions
+    and registers them all at once.
+    """
+    def register():
+        registrations = getattr(config, 'crom_registrations', None)
+        if registrations is None:
+            registry.register(sources, target, name, obj)
+        else:
+            registrations.append((registry, (sources, target, name, obj)))
+    config.action(
+        discriminator=('component', sources, target, name, registry),
+        callable=register
+        )
+
 @grokker
 @directive(sources)
 @directive(target)
 @directive(name)
 @directive(registry)
 def component(scanner, pyname, obj, sources, target, registry, name=''):
-    def register():
-        registry.register(sources, target, name, obj)
-    scanner.config.action(
-        discriminator=('component', sources, target, name, registry),
-        callable=register
-        )
+    register_action(scanner.config, registry, sources, target, name, obj)
 
 adapter = component
@@ -31,6 +31,17 @@ class ILookup(Interface):
         the target interface (although no such checking is done).
         """
 
+    def adapt_many(obs, target, name):
+        """Adapt each object in obs to target interface.
+
+        Returns an iterator with the result of adapting each object by
+        itself, like adapt does, in the same order. Objects are
+        adapted as the iterator is consumed, so obs can be a stream of
+        objects. This is faster than calling adapt for each of them,
+        as the adapter only needs to be looked up once for all objects
+        of the same class.
+        """
+
 class IChainLookup(ILookup):
     lookup = Attribute("The first ILookup to look in.")
     next = Attribute("The next ILookup in the chain.")
@@ -56,6 +67,17 @@ class IRegistry(Interface):
         registered.
         """
 
+    def register_many(registrations):
+        """Register a number of components with the registry at once.
+
+        registrations is an iterable of (sources, target, name,
+        component) tuples, with the same meaning as the arguments of
+        register. All of them are checked before any of them is
+        registered. This is faster than calling register for each of
+        them, which is useful when registering many components during
+        startup.
+        """
+
 class ICromInterface(Interface):
     pass
 
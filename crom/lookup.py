@@ -3,11 +3,12 @@ The basic ILookup is implemented by crom.Registry (in registry.py).
 This module contains alternative Lookups that can be used to combine
 lookups together.
 """
+from itertools import tee
 from .interfaces import ILookup, IChainLookup
 from .directives import implements
 
 @implements(ILookup)
-def ListLookup(object):
+class ListLookup(object):
     """A simple list of lookups functioning as an ILookup.
 
     Go through all items in the list, starting at the beginning and
@@ -26,10 +27,14 @@ def ListLookup(object):
 
     def adapt(self, obs, target, name):
         for lookup in self.lookups:
-            result = self.lookup.adapt(obs, target, name)
+            result = lookup.adapt(obs, target, name)
             if result is not None:
                 return result
         return None
+
+    def adapt_many(self, obs, target, name):
+        for ob in obs:
+            yield self.adapt([ob], target, name)
     
 @implements(IChainLookup)
 class ChainLookup(object):
@@ -54,3 +59,11 @@ class ChainLookup(object):
         if result is not None:
             return result
         return self.next.adapt(obs, target, name)
+
+    def adapt_many(self, obs, target, name):
+        obs, retry = tee(obs)
+        for result in self.lookup.adapt_many(obs, target, name):
+            ob = next(retry)
+            if result is None:
+                result = self.next.adapt([ob], target, name)
+            yield result
@@ -1,26 +1,136 @@
+import threading
+import weakref
+from itertools import islice, product
+
+NOT_FOUND = object()
+NOT_CACHED = object()
+
+def linearize(mapkey):
+    """C3 linearization of a map key and its ancestors.
+
+    This is the algorithm Python uses to determine the mro of a
+    class. It returns a list starting with mapkey itself, followed by
+    its ancestors, most specific first. Ancestors are compared by
+    identity, just as classes would be.
+
+    Raises TypeError if no consistent linearization exists.
+    """
+    sequences = [parent._parent_mapkeys for parent in mapkey.parents]
+    sequences.append(mapkey.parents)
+    sequences = [sequence for sequence in sequences if sequence]
+    # for each sequence the index of its head; everything after the
+    # head is the tail. We keep count of how often keys occur in
+    # tails, so that a candidate can be checked in constant time
+    heads = [0] * len(sequences)
+    in_tails = {}
+    for sequence in sequences:
+        for k in sequence[1:]:
+            in_tails[id(k)] = in_tails.get(id(k), 0) + 1
+    result = [mapkey]
+    active = list(range(len(sequences)))
+    while active:
+        for i in active:
+            candidate = sequences[i][heads[i]]
+            if not in_tails.get(id(candidate)):
+                break
+        else:
+            raise TypeError(
+                "Cannot create a consistent linearization for %r" % mapkey)
+        result.append(candidate)
+        remaining = []
+        for i in active:
+            sequence = sequences[i]
+            head = heads[i]
+            if sequence[head] is candidate:
+                head += 1
+                if head == len(sequence):
+                    continue
+                in_tails[id(sequence[head])] -= 1
+                heads[i] = head
+            remaining.append(i)
+        active = remaining
+    return result
+
 class MapKey(object):
     """A map key that can have parents.
+
+    Map keys are equal if their underlying keys are equal. Use
+    ``MapKey.get`` to obtain a shared map key instead of creating a
+    new one each time.
     """
+    __slots__ = ('key', 'parents', '_parent_mapkeys', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+    # class -> map key, see for_class
+    _classes = weakref.WeakKeyDictionary()
+
     def __init__(self, key, parents=()):
         self.key = key
         self.parents = tuple(parents)
-        # we need Python's mro, but we don't have classes. We create
-        # some with the same structure as our parent structure. then we
-        # get the mro
-        self._mro_helper = type('fake_type',
-                                tuple(parent._mro_helper for
-                                      parent in parents),
-                                {'mapkey': self})
-        # we then store the map keys for the mro (without the last
-        # entry, which is always object)
-        self._parent_mapkeys = [
-            base.mapkey for base in self._mro_helper.__mro__[:-1]]
+        # the map keys in lookup order: this key, followed by its
+        # ancestors in the same order Python would use for the mro of
+        # classes with this structure
+        self._parent_mapkeys = linearize(self)
+
+    @classmethod
+    def get(cls, key, parents=()):
+        """Get the shared map key for key, creating it if needed.
+
+        The map key is kept around for as long as it is in use
+        elsewhere. Raises ValueError if the existing map key has
+        different parents.
+        """
+        parents = tuple(parents)
+        mapkey = cls._interned.get(key)
+        if mapkey is None:
+            mapkey = cls._interned[key] = cls(key, parents)
+        elif mapkey.parents != parents:
+            raise ValueError(
+                "%r already exists with parents %r" %
+                (mapkey, mapkey.parents))
+        return mapkey
+
+    @classmethod
+    def for_class(cls, klass):
+        """Get the map key for a Python class.
+
+        The parents of the map key are the map keys for the bases of
+        the class, and its linearization is taken from the mro of the
+        class. The map key is created once for each class, and is
+        forgotten when the class goes away; its key is a weak
+        reference to the class. This makes it cheap to look things up
+        for ``type(obj)``.
+        """
+        mapkey = cls._classes.get(klass)
+        if mapkey is not None:
+            return mapkey
+        key = weakref.ref(klass)
+        # a weak reference can only be hashed while its object is
+        # alive, after which the hash is remembered
+        hash(key)
+        mapkey = cls._classes[klass] = cls._with_linearization(
+            key, [cls.for_class(base) for base in klass.__bases__],
+            [cls.for_class(ancestor) for ancestor in klass.__mro__[1:]])
+        return mapkey
+
+    @classmethod
+    def _with_linearization(cls, key, parents, ancestors):
+        # create a map key whose linearization is already known:
+        # ancestors are the map keys that follow it in the linearization
+        mapkey = cls.__new__(cls)
+        mapkey.key = key
+        mapkey.parents = tuple(parents)
+        mapkey._parent_mapkeys = [mapkey] + list(ancestors)
+        return mapkey
 
     def __hash__(self):
         return hash(self.key)
 
     def __eq__(self, other):
-        return self.key == other.key
+        return self is other or self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __repr__(self):
         return "<MapKey: %r>" % self.key
@@ -59,14 +169,195 @@ class Map(dict):
             return default
 
     def all(self, key):
-        result = []
+        return list(self.iter_all(key))
+
+    def iter_all(self, key, limit=None):
+        """Iterate over all values found for key, most specific first.
+
+        Values are looked up lazily as the iterator is consumed. If
+        limit is given, at most that many values are produced.
+        """
+        return islice(self._iter_all(key), limit)
+
+    def _iter_all(self, key):
         for mapkey in key._parent_mapkeys:
-            try:
-                result.append(self.exact_getitem(mapkey))
-            except KeyError:
-                pass
-        return result
+            value = self.exact_get(mapkey, NOT_FOUND)
+            if value is not NOT_FOUND:
+                yield value
     
+class MapKeyIndex(object):
+    """Integer encoding of a collection of MapKeys.
+
+    Each MapKey added gets an integer id. For each MapKey the index
+    stores its ancestors (including itself) as a bitset: an integer
+    with the bits for the ids of the ancestors set. This makes it
+    cheap to check whether one MapKey is an ancestor of another, and
+    to find the most specific ancestor out of a set of MapKeys,
+    however deep the hierarchy is.
+
+    MapKeys are added to the index automatically when they are
+    looked up. The bitsets grow with the number of MapKeys in the
+    index, so this is meant for collections of up to some ten
+    thousands of MapKeys.
+    """
+    def __init__(self, mapkeys=()):
+        self._ids = {}
+        self._mapkeys = []
+        self._ancestors = []
+        # for each id a dictionary from ancestor id to position in the
+        # linearization, filled in when needed
+        self._ranks = []
+        for mapkey in mapkeys:
+            self.add(mapkey)
+
+    def __len__(self):
+        return len(self._mapkeys)
+
+    def add(self, mapkey):
+        """Add mapkey and its ancestors to the index.
+
+        Returns the id of mapkey.
+        """
+        key_id = self._ids.get(mapkey)
+        if key_id is not None:
+            return key_id
+        # in the linearization a MapKey comes before all of its
+        # ancestors, so going through it backwards its parents are
+        # always added before it. We don't recurse, as hierarchies
+        # can be deeper than the recursion limit
+        for ancestor in reversed(mapkey._parent_mapkeys):
+            if ancestor in self._ids:
+                continue
+            ancestors = 0
+            for parent in ancestor.parents:
+                ancestors |= self._ancestors[self._ids[parent]]
+            key_id = self._ids[ancestor] = len(self._mapkeys)
+            self._mapkeys.append(ancestor)
+            self._ancestors.append(ancestors | (1 << key_id))
+            self._ranks.append(None)
+        return key_id
+
+    def id(self, mapkey):
+        return self.add(mapkey)
+
+    def mapkey(self, key_id):
+        return self._mapkeys[key_id]
+
+    def ancestors(self, mapkey):
+        """The bitset of the ancestors of mapkey, including itself.
+        """
+        return self._ancestors[self.add(mapkey)]
+
+    def is_ancestor(self, ancestor, mapkey):
+        """True if ancestor is mapkey or one of its ancestors.
+        """
+        return bool(self.ancestors(mapkey) >> self.add(ancestor) & 1)
+
+    def most_specific(self, mapkey, bits):
+        """Find the most specific ancestor of mapkey among bits.
+
+        bits is a bitset of ids. The ancestors of mapkey (including
+        itself) that are in it are compared by their position in the
+        linearization of mapkey. Returns None if there are none.
+        """
+        key_id = self.add(mapkey)
+        candidates = self._ancestors[key_id] & bits
+        if not candidates:
+            return None
+        # a single candidate is the common case
+        if not candidates & (candidates - 1):
+            return self._mapkeys[candidates.bit_length() - 1]
+        ranks = self._rank(key_id)
+        best = None
+        while candidates:
+            lowest = candidates & -candidates
+            candidates ^= lowest
+            candidate = lowest.bit_length() - 1
+            if best is None or ranks[candidate] < ranks[best]:
+                best = candidate
+        return self._mapkeys[best]
+
+    def in_order(self, mapkey, bits):
+        """The ancestors of mapkey among bits, most specific first.
+        """
+        key_id = self.add(mapkey)
+        candidates = self._ancestors[key_id] & bits
+        found = []
+        while candidates:
+            lowest = candidates & -candidates
+            candidates ^= lowest
+            found.append(lowest.bit_length() - 1)
+        found.sort(key=self._rank(key_id).__getitem__)
+        return [self._mapkeys[i] for i in found]
+
+    def _rank(self, key_id):
+        ranks = self._ranks[key_id]
+        if ranks is None:
+            ranks = self._ranks[key_id] = dict(
+                (self.add(ancestor), position) for position, ancestor in
+                enumerate(self._mapkeys[key_id]._parent_mapkeys))
+        return ranks
+
+class IndexedMap(Map):
+    """A Map that uses a MapKeyIndex for lookups.
+
+    Next to the values, an IndexedMap keeps the bitset of the MapKeys
+    it contains. A lookup combines this with the bitset of ancestors of
+    the key in a single operation, instead of trying each ancestor in
+    turn, so lookups don't get slower for deeper hierarchies.
+
+    Several IndexedMaps can share the same MapKeyIndex.
+    """
+    def __init__(self, index=None):
+        super(IndexedMap, self).__init__()
+        if index is None:
+            index = MapKeyIndex()
+        self.index = index
+        self._present = 0
+
+    def __setitem__(self, key, value):
+        self._present |= 1 << self.index.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._present &= ~(1 << self.index.add(key))
+
+    def __getitem__(self, key):
+        found = self.index.most_specific(key, self._present)
+        if found is None:
+            raise KeyError(key)
+        return self.exact_getitem(found)
+
+    def _iter_all(self, key):
+        for mapkey in self.index.in_order(key, self._present):
+            yield self.exact_getitem(mapkey)
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self.exact_getitem(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self.exact_getitem(key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._present &= ~(1 << self.index.add(key))
+        return key, value
+
+    def clear(self):
+        dict.clear(self)
+        self._present = 0
+
 class MultiMap(object):
     """map that takes sequences of MapKey objects as key.
 
@@ -81,74 +372,726 @@ class MultiMap(object):
     lookup, the one whose first component matches most specifically
     wins, the other components being considered as subordinate
     comparison criteria, in order.
+
+    The result of each lookup (including a failed lookup) is cached
+    by the sequence of MapKeys looked up, so that repeated lookups of
+    the same MultiMapKey only cost a single dictionary access. The
+    results of ``all`` are cached in the same way. The caches are
+    cleared whenever the MultiMap is changed.
+
+    Next to the lookup structure, the MultiMap keeps a flat dictionary
+    of the MultiMapKeys stored, which is used to look up values
+    exactly.
     """
+    # the kind of Map used to store the MultiMapKeys
+    _map_class = Map
+
     def __init__(self):
+        # arity -> tree of Maps, with one level per key component
         self._by_arity = {}
+        self._cache = {}
+        self._all_cache = {}
+        self._exact = {}
         
+    @classmethod
+    def from_items(cls, items):
+        """Create a MultiMap from an iterable of (key, value) pairs.
+        """
+        result = cls()
+        result.update(items)
+        return result
+
+    def freeze(self):
+        """Get an immutable copy of this MultiMap.
+
+        See FrozenMultiMap.
+        """
+        return FrozenMultiMap(self._exact.items())
+
+    def _clear_caches(self):
+        self._cache.clear()
+        self._all_cache.clear()
+
+    def update(self, items):
+        """Store all (key, value) pairs from an iterable.
+
+        This is faster than storing them one by one, which is useful
+        when populating a large MultiMap.
+        """
+        self._clear_caches()
+        for key, value in items:
+            self._set(key, value)
+
     def __setitem__(self, key, value):
-        arity = MapKey(len(key))
-        key = [arity] + list(key)
-        last_key = key.pop()
-        map = self._by_arity
-        for k in key:
-            # XXX why is the dict() call here?
-            submap = dict(map).get(k)
+        self._clear_caches()
+        self._set(key, value)
+
+    def _set(self, key, value):
+        key = tuple(key)
+        self._exact[key] = value
+        # the value for the empty MultiMapKey is only stored in the
+        # flat dictionary
+        if not key:
+            return
+        map = self._by_arity.get(len(key))
+        if map is None:
+            map = self._by_arity[len(key)] = self._map_class()
+        # we walk down the submaps for all but the last key component,
+        # and store the value under the last one. We use dict.get as
+        # Map.get would look up parents as well
+        for k in key[:-1]:
+            submap = dict.get(map, k)
             if submap is None:
-                submap = map[k] = Map()
+                submap = map[k] = self._map_class()
             map = submap
-        map[last_key] = value
+        map[key[-1]] = value
 
     def __delitem__(self, key):
-        arity = MapKey(len(key))
-        key = [arity] + list(key)
-        last_key = key.pop()
+        key = tuple(key)
+        del self._exact[key]
+        self._clear_caches()
+        if key:
+            self._remove(key)
+
+    def _remove(self, key, submap=dict.__getitem__):
+        # remove key from the tree, and remove the Maps that become
+        # empty. submap(map, k) gets the Map under k in map
+        path = []
         map = self._by_arity
-        for k in key:
-            map = dict(map)[k]
-        del map[last_key]
+        for k in (len(key),) + key[:-1]:
+            path.append((map, k))
+            map = submap(map, k)
+        del map[key[-1]]
+        while not map and path:
+            map, k = path.pop()
+            dict.__delitem__(map, k)
+
+    def compact(self):
+        """Rebuild the internal structures with only what is needed.
+
+        Dictionaries don't shrink when entries are removed from them,
+        so after many deletions this can free memory.
+        """
+        items = list(self._exact.items())
+        self._clear_storage()
+        self.update(items)
+
+    def _clear_storage(self):
+        self._by_arity = {}
+        self._exact = {}
+
+    def stats(self):
+        """Statistics about the internal structure.
+
+        Returns a dictionary with the number of entries, the number of
+        Maps that are used to store them and the depth of the deepest
+        Map.
+        """
+        nodes = 0
+        depth = 0
+        todo = [(map, 1, arity) for arity, map in self._by_arity.items()]
+        while todo:
+            map, level, arity = todo.pop()
+            nodes += 1
+            depth = max(depth, level)
+            if level < arity:
+                todo.extend((submap, level + 1, arity)
+                            for submap in map.values())
+        return {'entries': len(self._exact), 'nodes': nodes, 'depth': depth}
 
     def __getitem__(self, key):
-        arity = MapKey(len(key))
-        key = [arity] + list(key)
-        return self._getitem_recursive(self._by_arity, key)
-
-    # XXX missing exact_getitem, exact_get
-
-    def _getitem_recursive(self, map, key):
-        first = key[0]
-        rest = key[1:]
-        if not rest:
-            return map[first]
-        for parent in first._parent_mapkeys:
-            try:
-                return self._getitem_recursive(map[parent], rest)
-            except KeyError, e:
-                pass
-        raise e
+        key = tuple(key)
+        try:
+            result = self._cache[key]
+        except KeyError:
+            result = self._cache[key] = self._getitem_uncached(key)
+        if result is NOT_FOUND:
+            raise KeyError(key)
+        return result
+
+    def _getitem_uncached(self, key):
+        return next(self._iter_all(key), NOT_FOUND)
+
+    def get_many(self, keys, default=None):
+        """Look up a sequence of MultiMapKeys at once.
+
+        Returns a list with the value found for each MultiMapKey, in
+        the same order, or default if nothing was found. MultiMapKeys
+        that start with the same MapKey share the work of looking up
+        that MapKey.
+        """
+        cache = self._cache
+        # candidates for the first component, by arity and first
+        # component
+        firsts = {}
+        result = []
+        for key in keys:
+            key = tuple(key)
+            value = cache.get(key, NOT_CACHED)
+            if value is NOT_CACHED:
+                first = None
+                if key:
+                    group = (len(key), key[0])
+                    first = firsts.get(group)
+                    if first is None:
+                        first = firsts[group] = self._first_candidates(key)
+                value = cache[key] = next(self._iter_all(key, first),
+                                          NOT_FOUND)
+            result.append(default if value is NOT_FOUND else value)
+        return result
+
+    def exact_getitem(self, key):
+        """Get the value stored for exactly this MultiMapKey.
+
+        Parents of the key components are not taken into account.
+        """
+        return self._exact[tuple(key)]
+
+    def exact_get(self, key, default=None):
+        return self._exact.get(tuple(key), default)
+
+    def __contains__(self, key):
+        return tuple(key) in self._exact
+
+    def __len__(self):
+        return len(self._exact)
+
+    def all(self, key):
+        key = tuple(key)
+        found = self._all_cache.get(key)
+        if found is None:
+            found = self._all_cache[key] = tuple(self._iter_all(key))
+        return list(found)
+
+    def iter_all(self, key, limit=None):
+        """Iterate over all values found for key, most specific first.
+
+        Values are looked up lazily as the iterator is consumed, so
+        taking only the first few stops the search early. If limit is
+        given, at most that many values are produced.
+        """
+        found = self._all_cache.get(tuple(key))
+        if found is None:
+            found = self._iter_all(key)
+        return islice(found, limit)
+
+    def _first_candidates(self, key):
+        # the parents of the first component of a non-empty key which
+        # may lead to a value
+        map = self._by_arity.get(len(key), {})
+        return [mapkey for mapkey in key[0]._parent_mapkeys if mapkey in map]
+
+    def _iter_all(self, key, first=None):
+        # first, if given, is the result of _first_candidates(key)
+        if not key:
+            value = self._exact.get((), NOT_FOUND)
+            if value is not NOT_FOUND:
+                yield value
+            return
+        map = self._by_arity.get(len(key))
+        if map is None:
+            return
+        if first is None:
+            first = key[0]._parent_mapkeys
+        # depth-first search through the candidates, most specific
+        # first. candidates[depth] iterates over the parents of the
+        # key component at that depth, maps[depth] is the map they are
+        # looked up in. Iterators pick up where they left off when we
+        # backtrack.
+        last = len(key) - 1
+        maps = [map]
+        candidates = [iter(first)]
+        while candidates:
+            depth = len(candidates) - 1
+            map = maps[depth]
+            for mapkey in candidates[depth]:
+                found = map.exact_get(mapkey, NOT_FOUND)
+                if found is NOT_FOUND:
+                    continue
+                if depth == last:
+                    yield found
+                    continue
+                maps.append(found)
+                candidates.append(iter(key[depth + 1]._parent_mapkeys))
+                break
+            else:
+                maps.pop()
+                candidates.pop()
+
+
+class FlatMultiMap(MultiMap):
+    """A MultiMap that stores all entries in a single dictionary.
+
+    The MultiMapKeys are stored as tuples in one dictionary, instead
+    of in a tree of Maps with one Map per key prefix. For each arity
+    we keep track of which MapKeys occur at each position. During
+    lookup only the parents that occur at a position are combined,
+    and the combinations are looked up in the dictionary, most
+    specific first.
+
+    This uses less memory for a MultiMap with many MultiMapKeys of
+    arity 2 or more. Lookups can be slower if many combinations of
+    parents have to be tried, as combinations that a tree would rule
+    out early are each looked up in the dictionary.
+    """
+    def __init__(self):
+        super(FlatMultiMap, self).__init__()
+        # arity -> a dictionary per position, counting how often
+        # each MapKey occurs in that position
+        self._positions = {}
+
+    def _set(self, key, value):
+        key = tuple(key)
+        if key not in self._exact:
+            positions = self._positions.get(len(key))
+            if positions is None:
+                positions = self._positions[len(key)] = [{} for k in key]
+            for k, present in zip(key, positions):
+                present[k] = present.get(k, 0) + 1
+        self._exact[key] = value
+
+    def __delitem__(self, key):
+        key = tuple(key)
+        del self._exact[key]
+        self._clear_caches()
+        positions = self._positions[len(key)]
+        for k, present in zip(key, positions):
+            if present[k] == 1:
+                del present[k]
+            else:
+                present[k] -= 1
+        if not positions or not positions[0]:
+            del self._positions[len(key)]
+
+    def _clear_storage(self):
+        super(FlatMultiMap, self)._clear_storage()
+        self._positions = {}
+
+    def stats(self):
+        """Statistics about the internal structure.
+
+        Returns a dictionary with the number of entries, the number of
+        dictionaries that index the positions and the depth, which is
+        1 as all entries are in the same dictionary.
+        """
+        return {'entries': len(self._exact),
+                'nodes': sum(len(positions) for positions in
+                             self._positions.values()),
+                'depth': 1 if self._exact else 0}
+
+    def _first_candidates(self, key):
+        present = self._positions.get(len(key), [{}])[0]
+        return [mapkey for mapkey in key[0]._parent_mapkeys
+                if mapkey in present]
+
+    def _iter_all(self, key, first=None):
+        positions = self._positions.get(len(key))
+        if positions is None:
+            return
+        if first is None:
+            candidates = []
+        else:
+            if not first:
+                return
+            candidates = [first]
+            key = key[1:]
+            positions = positions[1:]
+        for k, present in zip(key, positions):
+            found = [mapkey for mapkey in k._parent_mapkeys
+                     if mapkey in present]
+            if not found:
+                return
+            candidates.append(found)
+        # product varies the last component fastest, so the first
+        # component wins
+        for candidate in product(*candidates):
+            value = self._exact.get(candidate, NOT_FOUND)
+            if value is not NOT_FOUND:
+                yield value
+
+class ConcurrentMultiMap(object):
+    """A MultiMap that can be changed while other threads use it.
+
+    The entries are kept in a MultiMap that is never changed once it
+    is in use. A change creates a new version of that MultiMap, which
+    shares all Maps that are not on the path of the changed keys with
+    the previous version, and then replaces the current version in
+    one step. Threads that look things up never need to lock and
+    always see a consistent version; a single lookup, ``get_many`` or
+    ``all`` only ever sees one version.
+
+    Changes are made one thread at a time. Each change copies the
+    flat dictionary of entries, so changes get slower as the
+    ConcurrentMultiMap grows; use ``update`` to make several changes
+    at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = _MultiMapVersion()
+
+    @classmethod
+    def from_items(cls, items):
+        result = cls()
+        result.update(items)
+        return result
+
+    def snapshot(self):
+        """The current version as a MultiMap.
+
+        It won't change when the ConcurrentMultiMap changes. It cannot
+        be changed itself, as it shares its Maps with other versions.
+        """
+        return self._current
+
+    def freeze(self):
+        return self._current.freeze()
+
+    def __getitem__(self, key):
+        return self._current[key]
+
+    def get_many(self, keys, default=None):
+        return self._current.get_many(keys, default)
+
+    def exact_getitem(self, key):
+        return self._current.exact_getitem(key)
+
+    def exact_get(self, key, default=None):
+        return self._current.exact_get(key, default)
+
+    def __contains__(self, key):
+        return key in self._current
+
+    def __len__(self):
+        return len(self._current)
+
+    def stats(self):
+        return self._current.stats()
+
+    def compact(self):
+        with self._lock:
+            version = _MultiMapVersion()
+            MultiMap.update(version, self._current._exact.items())
+            self._current = version
 
     def all(self, key):
-        arity = MapKey(len(key))
-        key = [arity] + list(key)
-        found = {}
-        return self._all_recursive(found, self._by_arity, key)
-
-    def _all_recursive(self, found, map, key):
-        value = found.get(key)
-        if value is not None:
-            return value
-        first = key[0]
-        rest = key[1:]
-        if not rest:
-            value = map.all(first)
-            found[first] = value
-            return value
+        return self._current.all(key)
+
+    def iter_all(self, key, limit=None):
+        return self._current.iter_all(key, limit)
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def update(self, items):
+        with self._lock:
+            version, fresh = self._new_version()
+            for key, value in items:
+                self._set(version, fresh, tuple(key), value)
+            self._current = version
+
+    def __delitem__(self, key):
+        with self._lock:
+            version, fresh = self._new_version()
+            self._delete(version, fresh, tuple(key))
+            self._current = version
+
+    def _new_version(self):
+        # a new version shares its Maps with the current version.
+        # fresh keeps track of the Maps that were copied for the new
+        # version: only those can be changed
+        current = self._current
+        version = _MultiMapVersion()
+        version._by_arity = dict(current._by_arity)
+        version._exact = dict(current._exact)
+        return version, set()
+
+    def _submap(self, fresh, map, k):
+        # get the submap of map under k, ready to be changed
+        submap = dict.get(map, k)
+        if submap is None:
+            submap = Map()
+        elif id(submap) in fresh:
+            return submap
+        else:
+            submap = Map(submap)
+        fresh.add(id(submap))
+        dict.__setitem__(map, k, submap)
+        return submap
+
+    def _set(self, version, fresh, key, value):
+        version._exact[key] = value
+        if not key:
+            return
+        map = self._submap(fresh, version._by_arity, len(key))
+        for k in key[:-1]:
+            map = self._submap(fresh, map, k)
+        map[key[-1]] = value
+
+    def _delete(self, version, fresh, key):
+        del version._exact[key]
+        if key:
+            version._remove(
+                key, lambda map, k: self._submap(fresh, map, k))
+
+class _MultiMapVersion(MultiMap):
+    # a version of the entries of a ConcurrentMultiMap, which shares
+    # its Maps with other versions. ConcurrentMultiMap changes the new
+    # version it creates directly, but nobody else may change it
+    def compact(self):
+        pass
+
+    def _immutable(self, *args):
+        raise TypeError("A ConcurrentMultiMap snapshot cannot be changed")
+
+    __setitem__ = __delitem__ = update = _immutable
+
+class FrozenMultiMap(MultiMap):
+    """An immutable MultiMap, optimized for lookups.
+
+    The values found for all stored MultiMapKeys, and for all
+    MultiMapKeys made up from the parents of their components, are
+    looked up in advance. Other MultiMapKeys are looked up when first
+    needed and then remembered. Since a FrozenMultiMap cannot change,
+    all this can be done without locking, so a FrozenMultiMap can be
+    shared between threads.
+    """
+    def __init__(self, items=()):
+        super(FrozenMultiMap, self).__init__()
+        super(FrozenMultiMap, self).update(items)
+        for key in self._exact:
+            parents = [k._parent_mapkeys for k in key]
+            for candidate in product(*parents):
+                if candidate not in self._cache:
+                    self._cache[candidate] = self._getitem_uncached(candidate)
+
+    @classmethod
+    def from_items(cls, items):
+        return cls(items)
+
+    def freeze(self):
+        return self
+
+    def compact(self):
+        # there is never anything to remove
+        pass
+
+    def _immutable(self, *args):
+        raise TypeError("FrozenMultiMap cannot be changed")
+
+    __setitem__ = __delitem__ = update = _immutable
+
+
+class LookupStats(object):
+    """Counts lookups, hits and misses.
+
+    ``positions`` counts how often a hit occurred at each position in
+    the linearization of the key looked up: 0 if the key itself was
+    found, 1 for the first ancestor, and so on. For a MultiMap the
+    position is a tuple with a position for each component.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.positions = {}
+
+    def record(self, position):
+        """Record a lookup. position is None for a miss.
+        """
+        self.lookups += 1
+        if position is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        self.positions[position] = self.positions.get(position, 0) + 1
+
+class InstrumentedMap(Map):
+    """A Map that records statistics about its lookups in ``stats``.
+
+    Use this instead of Map to find out how lookups behave; a normal
+    Map doesn't pay anything for this.
+    """
+    def __init__(self, *args, **kw):
+        super(InstrumentedMap, self).__init__(*args, **kw)
+        self.stats = LookupStats()
+
+    def __getitem__(self, key):
+        for position, mapkey in enumerate(key._parent_mapkeys):
+            value = self.exact_get(mapkey, NOT_FOUND)
+            if value is not NOT_FOUND:
+                self.stats.record(position)
+                return value
+        self.stats.record(None)
+        raise KeyError(key)
+
+class InstrumentedMultiMap(MultiMap):
+    """A MultiMap that records statistics about its lookups in ``stats``.
+
+    Use this instead of MultiMap to find out how lookups behave; a
+    normal MultiMap doesn't pay anything for this. It can be combined
+    with other kinds of MultiMap by subclassing, for instance::
+
+      class InstrumentedFlatMultiMap(InstrumentedMultiMap, FlatMultiMap):
+          pass
+
+    Lookups with ``[]`` are recorded.
+    """
+    def __init__(self, *args, **kw):
+        self.stats = LookupStats()
+        # MultiMapKey -> position of the hit, cached like the results
+        self._hit_positions = {}
+        super(InstrumentedMultiMap, self).__init__(*args, **kw)
+
+    def _clear_caches(self):
+        super(InstrumentedMultiMap, self)._clear_caches()
+        self._hit_positions.clear()
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        try:
+            position = self._hit_positions[key]
+        except KeyError:
+            position = self._hit_positions[key] = self._hit_position(key)
+        self.stats.record(position)
+        return super(InstrumentedMultiMap, self).__getitem__(key)
+
+    def _hit_position(self, key):
+        # the candidates are tried in the same order as in a lookup,
+        # so the first one stored is the one found
+        for candidate in product(*[enumerate(k._parent_mapkeys)
+                                   for k in key]):
+            if tuple(mapkey for position, mapkey in candidate) in self._exact:
+                return tuple(position for position, mapkey in candidate)
+        return None
+
+
+class _WeakKey(weakref.ref):
+    """A weak reference to a MapKey that is equal to the MapKey.
+
+    This way a dictionary with weak keys can be looked up with the
+    MapKeys themselves. owner is the dictionary key the weak reference
+    is part of, if that is not the weak reference itself.
+    """
+    __slots__ = ('_hash', 'owner')
+
+    def __new__(cls, mapkey, callback=None, owner=None):
+        return super(_WeakKey, cls).__new__(cls, mapkey, callback)
+
+    def __init__(self, mapkey, callback=None, owner=None):
+        super(_WeakKey, self).__init__(mapkey, callback)
+        # we need the hash after the MapKey has gone to remove the entry
+        self._hash = hash(mapkey)
+        self.owner = owner
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, _WeakKey):
+            other = other()
+        mapkey = self()
+        return mapkey is not None and other is not None and mapkey == other
+
+    def __ne__(self, other):
+        return not self == other
+
+class _WeakKeyDict(dict):
+    """A dictionary that holds its keys weakly.
+
+    Keys are MapKeys or tuples of MapKeys. An entry is removed when
+    one of the MapKeys in its key goes away. The dictionary can be
+    looked up with the MapKeys as usual.
+    """
+    def __init__(self, *args, **kw):
+        super(_WeakKeyDict, self).__init__()
+        # the callback must not keep the dictionary alive
+        self_ref = weakref.ref(self)
+        def remove(weak_key):
+            self = self_ref()
+            if self is not None:
+                owner = weak_key.owner
+                dict.pop(self, weak_key if owner is None else owner, None)
+        self._remove = remove
+        self.update(*args, **kw)
+
+    def _weak_key(self, key):
+        if not isinstance(key, tuple):
+            return _WeakKey(key, self._remove)
+        weak_keys = [_WeakKey(k, self._remove) for k in key]
+        result = tuple(weak_keys)
+        for weak_key in weak_keys:
+            weak_key.owner = result
+        return result
+
+    def _strong_key(self, weak_key):
+        # None if a MapKey has gone
+        if not isinstance(weak_key, tuple):
+            return weak_key()
+        result = tuple(k() for k in weak_key)
+        for k in result:
+            if k is None:
+                return None
+        return result
+
+    def __setitem__(self, key, value):
+        if key in self:
+            # keep the weak key that is already there
+            dict.__setitem__(self, key, value)
+        else:
+            dict.__setitem__(self, self._weak_key(key), value)
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def items(self):
         result = []
-        for parent in first._parent_mapkeys:
-            try:
-                result.extend(self._all_recursive(found, map[parent], rest))
-            except KeyError, e:
-                pass
-        found[key] = result
+        for weak_key, value in list(dict.items(self)):
+            key = self._strong_key(weak_key)
+            if key is not None:
+                result.append((key, value))
         return result
 
-    
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+class WeakMap(_WeakKeyDict, Map):
+    """A Map that holds its keys weakly.
+
+    An entry is removed as soon as its MapKey is not used anywhere
+    else anymore. Use this in long-running processes that create
+    MapKeys on the fly, for instance with ``MapKey.for_class`` for
+    classes that are created dynamically, so that the Map does not
+    keep them around forever.
+    """
+
+class WeakMultiMap(MultiMap):
+    """A MultiMap that holds its MultiMapKeys weakly.
+
+    An entry is removed as soon as one of the MapKeys in its
+    MultiMapKey is not used anywhere else anymore. The cached lookup
+    results hold the MultiMapKeys looked up weakly as well. See
+    WeakMap.
+    """
+    _map_class = WeakMap
+
+    def __init__(self):
+        super(WeakMultiMap, self).__init__()
+        self._cache = _WeakKeyDict()
+        self._all_cache = _WeakKeyDict()
+        self._exact = _WeakKeyDict()
+
+    def _clear_storage(self):
+        super(WeakMultiMap, self)._clear_storage()
+        self._exact = _WeakKeyDict()
@@ -1,9 +1,10 @@
 from zope.interface.interface import InterfaceClass
-from .extiface import component_lookup, adapter_lookup
+from .extiface import component_lookup, adapter_lookup, adapter_many_lookup
 
 def safe():
     InterfaceClass.component = component_lookup
     InterfaceClass.adapt = adapter_lookup
+    InterfaceClass.adapt_many = adapter_many_lookup
 
 def incompat():
     safe()
@@ -15,6 +16,7 @@ def incompat():
 def revert_safe():
     del InterfaceClass.component
     del InterfaceClass.adapt
+    del InterfaceClass.adapt_many
     
 def revert_incompat():
     revert_safe()
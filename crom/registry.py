@@ -4,13 +4,101 @@ from zope.interface.adapter import AdapterRegistry
 from ._compat import CLASS_TYPES
 from .interfaces import IRegistry, ILookup
 from .directives import implements
+from .mapping import MapKey, MultiMap
+
+# marks self-adaptation in Registry.adapt_many
+_SELF = object()
+
+def _class_of(ob):
+    """The class of ob, if it determines what ob provides.
+
+    Returns None if ob provides interfaces directly, is a class
+    itself, or pretends to be of another class than it is, like a
+    proxy does.
+    """
+    cls = type(ob)
+    if ob.__class__ is not cls or isinstance(ob, CLASS_TYPES):
+        return None
+    ob_dict = getattr(ob, '__dict__', None)
+    if ob_dict is not None and '__provides__' in ob_dict:
+        return None
+    return cls
+
+def _classes(obs):
+    # the classes of obs, or None if that is None for one of them
+    result = []
+    for ob in obs:
+        cls = _class_of(ob)
+        if cls is None:
+            return None
+        result.append(cls)
+    return tuple(result)
+
+def _call_adapter(adapter, obs):
+    try:
+        return adapter(*obs)
+    except TypeError as e:
+        raise TypeError(str(e) + " (%s)" % adapter)
+
+def _ignore_change(originally_changed):
+    pass
 
 @implements(IRegistry, ILookup)
 class Registry(object):
+    """The default IRegistry and ILookup.
+
+    Lookups for objects whose interfaces all come from their classes
+    are cached by those classes, so that the interfaces they provide
+    don't need to be worked out again. The cache is cleared when a
+    component is registered. It is not cleared when the interfaces
+    declared for a class change, so declare those before using the
+    class in lookups.
+    """
+    # set by freeze
+    _frozen = False
+
     def __init__(self):
         self.registry = AdapterRegistry()
+        # (classes, target, name) -> component or None
+        self._class_cache = {}
+
+    def freeze(self):
+        """Get an immutable version of this registry, optimized for lookups.
+
+        Afterwards components cannot be registered with this registry
+        anymore either. See FrozenRegistry.
+        """
+        self._frozen = True
+        return FrozenRegistry(self)
+
+    def _check_not_frozen(self):
+        if self._frozen:
+            raise TypeError("Registry is frozen and cannot be changed")
 
     def register(self, sources, target, name, component):
+        self._check_not_frozen()
+        self.registry.register(self._iface_sources(sources),
+                               target, name, component)
+        self._class_cache.clear()
+
+    def register_many(self, registrations):
+        self._check_not_frozen()
+        registrations = [
+            (self._iface_sources(sources), target, name, component)
+            for sources, target, name, component in registrations]
+        registry = self.registry
+        # the underlying registry clears its caches after each
+        # registration; we only need that to happen once, at the end
+        registry.changed = _ignore_change
+        try:
+            for iface_sources, target, name, component in registrations:
+                registry.register(iface_sources, target, name, component)
+        finally:
+            del registry.changed
+            registry.changed(registry)
+            self._class_cache.clear()
+
+    def _iface_sources(self, sources):
         iface_sources = []
         for source in sources:
             if ISpecification.providedBy(source):
@@ -21,9 +109,20 @@ class Registry(object):
             else:
                 raise TypeError("Sources must either be "
                                 "an interface or a class.")
-        self.registry.register(iface_sources, target, name, component)
+        return iface_sources
 
     def lookup(self, obs, target, name):
+        classes = _classes(obs)
+        if classes is None:
+            return self._lookup(obs, target, name)
+        key = (classes, target, name)
+        try:
+            return self._class_cache[key]
+        except KeyError:
+            result = self._class_cache[key] = self._lookup(obs, target, name)
+            return result
+
+    def _lookup(self, obs, target, name):
         return self.registry.lookup(map(providedBy, obs), target, name)
 
     def adapt(self, obs, target, name):
@@ -33,7 +132,216 @@ class Registry(object):
         adapter = self.lookup(obs, target, name)
         if adapter is None:
             return None
+        return _call_adapter(adapter, obs)
+
+    def adapt_many(self, obs, target, name):
+        # adapters by class, so that we only look them up once
+        adapters = {}
+        for ob in obs:
+            cls = _class_of(ob)
+            if cls is None:
+                yield self.adapt([ob], target, name)
+                continue
+            try:
+                adapter = adapters[cls]
+            except KeyError:
+                if target.providedBy(ob):
+                    adapter = _SELF
+                else:
+                    adapter = self.lookup([ob], target, name)
+                adapters[cls] = adapter
+            if adapter is _SELF:
+                yield ob
+            elif adapter is None:
+                yield None
+            else:
+                yield _call_adapter(adapter, [ob])
+
+@implements(IRegistry, ILookup)
+class MultiMapRegistry(Registry):
+    """An IRegistry and ILookup built on crom's own MultiMap.
+
+    This can be used instead of Registry, which uses the
+    AdapterRegistry of zope.interface. Interfaces and classes are
+    turned into MapKeys, with the specifications they extend as their
+    parents. There is a MultiMap per name, with the MapKeys of the
+    sources followed by a MapKey for the target as MultiMapKey.
+
+    Like with Registry, a component registered for a target is also
+    found when looking up an interface that the target extends, and
+    lookups are cached by class. The MapKeys are made again after each
+    registration, so that, as with Registry, changes to the interfaces
+    declared for a class are picked up after the next registration.
+    """
+    def __init__(self):
+        # name -> MultiMap
+        self._multimaps = {}
+        # specifications are looked up by identity, as interfaces
+        # with the same name and module compare equal. We keep them
+        # around so that their ids stay valid.
+        # id of specification -> specification
+        self._specs = {}
+        # id of specification -> MapKey
+        self._mapkeys = {}
+        # id of target -> [target, number of registrations for it]
+        self._targets = {}
+        # id of interface -> the targets registered that are or
+        # extend it, in the order in which they are tried
+        self._extendors = {}
+        # id of target -> (target, MapKey used to look it up)
+        self._target_lookups = {}
+        self._class_cache = {}
+
+    def register(self, sources, target, name, component):
+        self.register_many([(sources, target, name, component)])
+
+    def register_many(self, registrations):
+        self._check_not_frozen()
+        by_name = {}
+        for sources, target, name, component in registrations:
+            key = tuple(self._mapkey(source) for source in
+                        self._iface_sources(sources))
+            by_name.setdefault(name, []).append((key, target, component))
+        for name, items in by_name.items():
+            multimap = self._multimaps.get(name)
+            if multimap is None:
+                multimap = self._multimaps[name] = MultiMap()
+            # we change the MultiMap directly, and clear its caches
+            # once at the end
+            for key, target, component in items:
+                key = key + (self._mapkey(target),)
+                old = multimap.exact_get(key)
+                if component is None:
+                    # registering None removes a registration, as it
+                    # does for Registry
+                    if old is not None:
+                        del multimap[key]
+                        self._remove_target(target)
+                elif component is not old:
+                    # like zope.interface we count a registration
+                    # each time a different component is registered
+                    self._add_target(target)
+                    multimap._set(key, component)
+        # the specifications may have changed since their MapKeys
+        # were made; MapKeys made again are equal to the old ones, so
+        # the MultiMaps only need to forget what they looked up
+        self._mapkeys.clear()
+        self._target_lookups.clear()
+        for multimap in self._multimaps.values():
+            multimap._clear_caches()
+        self._class_cache.clear()
+        # only the specifications in registered keys need to keep
+        # their ids; letting go of the rest, which were only looked
+        # up, means we don't keep classes alive that are thrown away
+        used = set()
+        for multimap in self._multimaps.values():
+            for key in multimap._exact:
+                used.update(mapkey.key for mapkey in key)
+        self._specs = dict((spec_id, spec) for spec_id, spec in
+                           self._specs.items() if spec_id in used)
+
+    def _lookup(self, obs, target, name):
+        multimap = self._multimaps.get(name)
+        if multimap is None:
+            return None
+        found = self._target_lookups.get(id(target))
+        if found is None:
+            found = self._target_lookup(target)
+        key = tuple([self._mapkey(providedBy(ob)) for ob in obs])
+        try:
+            return multimap[key + (found[1],)]
+        except KeyError:
+            return None
+
+    def _mapkey(self, spec):
+        # the MapKey for an interface specification
+        mapkey = self._mapkeys.get(id(spec))
+        if mapkey is not None:
+            return mapkey
+        mapkey = MapKey._with_linearization(
+            id(spec), [self._mapkey(base) for base in spec.__bases__],
+            [self._mapkey(ancestor) for ancestor in spec.__sro__[1:]])
+        self._specs[id(spec)] = spec
+        self._mapkeys[id(spec)] = mapkey
+        return mapkey
+
+    def _add_target(self, target):
+        # we keep track of the registered targets and the interfaces
+        # they extend the way zope.interface does
+        found = self._targets.get(id(target))
+        if found is not None:
+            found[1] += 1
+            return
+        self._targets[id(target)] = [target, 1]
+        for iface in target.__iro__:
+            extendors = self._extendors.get(id(iface), [])
+            self._extendors[id(iface)] = (
+                [e for e in extendors if target.isOrExtends(e)] +
+                [target] +
+                [e for e in extendors if not target.isOrExtends(e)])
+        self._target_lookups.clear()
+
+    def _remove_target(self, target):
+        found = self._targets[id(target)]
+        found[1] -= 1
+        if found[1]:
+            return
+        del self._targets[id(target)]
+        for iface in target.__iro__:
+            self._extendors[id(iface)] = [
+                e for e in self._extendors.get(id(iface), [])
+                if e is not target]
+        self._target_lookups.clear()
+
+    def _target_lookup(self, target):
+        # a MapKey for looking up target, which is followed by the
+        # targets registered that are or extend it. Its key differs
+        # from that of any MapKey registered, so only its ancestors
+        # are found
+        extendors = [self._mapkey(e) for e in
+                     self._extendors.get(id(target), [])]
+        found = self._target_lookups[id(target)] = (
+            target, MapKey._with_linearization(('lookup', id(target)), (),
+                                               extendors))
+        return found
+
+@implements(IRegistry, ILookup)
+class FrozenRegistry(Registry):
+    """An immutable registry, optimized for lookups.
+
+    This is created by the freeze method of a registry, which cannot
+    be changed afterwards. The result of looking up a combination of
+    classes, or of the specifications provided by the objects if they
+    don't come from their classes alone, together with a target and
+    name is remembered in a dispatch table the first time it is
+    needed, so that after that a lookup is a single dictionary access.
+    Since the registry can't change, nothing ever needs to be removed
+    from the dispatch table. Adding an entry is a single operation,
+    so a FrozenRegistry can be shared between threads without
+    locking.
+    """
+    def __init__(self, registry):
+        self._registry = registry
+        # (classes or specifications, target, name) -> component or None
+        self._dispatch = {}
+
+    def freeze(self):
+        return self
+
+    def lookup(self, obs, target, name):
+        classes = _classes(obs)
+        if classes is None:
+            key = (tuple(map(providedBy, obs)), target, name)
+        else:
+            key = (classes, target, name)
         try:
-            return adapter(*obs)
-        except TypeError, e:
-            raise TypeError(str(e) + " (%s)" % adapter)
+            return self._dispatch[key]
+        except KeyError:
+            result = self._dispatch[key] = self._registry._lookup(
+                obs, target, name)
+            return result
+
+    def _immutable(self, *args):
+        raise TypeError("FrozenRegistry cannot be changed")
+
+    register = register_many = _immutable
@@ -0,0 +1,152 @@
+"""
+Save a MultiMap to a file and load it again.
+
+Building a large MultiMap, including the MapKeys it uses, can take a
+while. A snapshot stores the MapKeys with their parents and their
+linearization, and the MultiMap entries. Loading a snapshot recreates
+the MapKeys directly, without computing their linearization again, and
+fills the MultiMap in one go.
+
+MapKey keys must be simple values (strings, numbers, tuples of
+those). Values are stored by dotted name, so they must be functions,
+classes or other objects that can be imported by their module and
+name. Loading a snapshot imports whatever dotted names are in it, so
+only load snapshots from a trusted source.
+
+Snapshots are stored with marshal, whose format can differ between
+versions of Python. A snapshot can only be loaded by the same version
+of Python that made it.
+"""
+import gc
+import marshal
+import sys
+from .mapping import MapKey, MultiMap
+
+FORMAT = 'crom.snapshot'
+VERSION = 2
+
+def _header():
+    # marshal can't store the version_info object itself
+    return (FORMAT, VERSION, marshal.version, tuple(sys.version_info[:2]))
+
+def resolve(dotted_name):
+    """Import the object with the given dotted name.
+    """
+    parts = dotted_name.split('.')
+    used = parts[0]
+    found = __import__(used)
+    for part in parts[1:]:
+        used += '.' + part
+        try:
+            found = getattr(found, part)
+        except AttributeError:
+            __import__(used)
+            found = getattr(found, part)
+    return found
+
+def dotted_name(value):
+    """Get the dotted name under which value can be imported.
+
+    Raises ValueError if there is no such name.
+    """
+    name = getattr(value, '__name__', None)
+    module = getattr(value, '__module__', None)
+    if name is not None and module is not None:
+        result = '%s.%s' % (module, name)
+        try:
+            if resolve(result) is value:
+                return result
+        except (ImportError, AttributeError):
+            pass
+    raise ValueError("Cannot refer to %r by dotted name." % value)
+
+def dump(multimap, f):
+    """Write a snapshot of multimap to the binary file f.
+    """
+    # number the MapKeys so that parents always come before their
+    # children
+    numbers = {}
+    keys = []
+    def number(mapkey):
+        result = numbers.get(id(mapkey))
+        if result is not None:
+            return result
+        # in the linearization a MapKey comes before all of its
+        # ancestors, so going through it backwards we number the
+        # ancestors of a MapKey before it, without recursing
+        for ancestor in reversed(mapkey._parent_mapkeys):
+            if id(ancestor) in numbers:
+                continue
+            parents = tuple(numbers[id(parent)] for parent in
+                            ancestor.parents)
+            linearization = tuple(numbers[id(later)] for later in
+                                  ancestor._parent_mapkeys[1:])
+            result = numbers[id(ancestor)] = len(keys)
+            keys.append((ancestor.key, parents, linearization))
+        return result
+    # entries are stored per arity, as one flat list of MapKey
+    # numbers and one list of value numbers
+    names = []
+    name_numbers = {}
+    by_arity = {}
+    for key, value in multimap._exact.items():
+        name = dotted_name(value)
+        name_number = name_numbers.get(name)
+        if name_number is None:
+            name_number = name_numbers[name] = len(names)
+            names.append(name)
+        entries = by_arity.get(len(key))
+        if entries is None:
+            entries = by_arity[len(key)] = ([], [])
+        entries[0].extend(number(mapkey) for mapkey in key)
+        entries[1].append(name_number)
+    entries = [(arity, key_numbers, value_numbers) for
+               arity, (key_numbers, value_numbers) in by_arity.items()]
+    marshal.dump(_header() + (keys, names, entries), f)
+
+def load(f, cls=MultiMap):
+    """Load a MultiMap from a snapshot in the binary file f.
+
+    cls is the MultiMap class to create. The MapKeys in the snapshot
+    are made available through MapKey.get, unless a MapKey with that
+    key already exists.
+    """
+    # loading creates a lot of objects, none of them garbage, so we
+    # don't let the garbage collector look at them all repeatedly
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load(marshal.loads(f.read()), cls)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _load(data, cls):
+    header = _header()
+    if not isinstance(data, tuple) or data[:2] != header[:2]:
+        raise ValueError("Not a crom snapshot of version %s." % VERSION)
+    if data[2:4] != header[2:4]:
+        raise ValueError(
+            "Snapshot was made with marshal version %s and Python %s.%s, "
+            "cannot load it with marshal version %s and Python %s.%s." %
+            ((data[2],) + tuple(data[3]) + (header[2],) + header[3]))
+    keys, names, entries = data[4:]
+    interned = MapKey._interned
+    mapkeys = []
+    for key, parents, linearization in keys:
+        mapkey = MapKey._with_linearization(
+            key, [mapkeys[i] for i in parents],
+            [mapkeys[i] for i in linearization])
+        interned.setdefault(key, mapkey)
+        mapkeys.append(mapkey)
+    values = [resolve(name) for name in names]
+    items = []
+    for arity, key_numbers, value_numbers in entries:
+        if arity:
+            components = iter([mapkeys[i] for i in key_numbers])
+            keys = zip(*[components] * arity)
+        else:
+            keys = [()] * len(value_numbers)
+        items.extend(zip(keys, [values[i] for i in value_numbers]))
+    # from_items, as some MultiMaps can't be changed once made
+    return cls.from_items(items)
@@ -0,0 +1,33 @@
+import crom
+import grokker
+from crom.grokkers import register_action
+
+@grokker.grokker
+@grokker.directive(crom.registry)
+def bad(scanner, pyname, obj, registry):
+    # the sources directive would refuse this source
+    register_action(scanner.config, registry, (object(),), ITarget, '', obj)
+
+class ISource(crom.Interface):
+    pass
+
+class ITarget(crom.Interface):
+    pass
+
+@crom.implements(ISource)
+class Source(object):
+    pass
+
+@crom.adapter
+@crom.sources(ISource)
+@crom.target(ITarget)
+@crom.name('good')
+@crom.implements(ITarget)
+class Adapter(object):
+    def __init__(self, context):
+        self.context = context
+
+@bad
+class BadAdapter(object):
+    def __init__(self, context):
+        self.context = context
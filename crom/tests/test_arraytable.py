@@ -0,0 +1,80 @@
+import random
+import py.test
+from crom import MapKey, MultiMap, MapKeyIndex
+
+numpy = py.test.importorskip('numpy')
+
+from crom.arraytable import ArrayTable
+
+def test_lookup_array():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m = MultiMap()
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+    m[(alpha,)] = u'Value for alpha'
+
+    index = MapKeyIndex([alpha, beta, gamma, one, two, three])
+    table = ArrayTable(m, index, 2)
+    assert len(table.values) == 3
+
+    keys = [(gamma, three), (alpha, two), (alpha, three), (one, alpha),
+            (beta, one)]
+    found = table.lookup_array(
+        [[index.id(first) for first, second in keys],
+         [index.id(second) for first, second in keys]])
+    assert [table.values[i] if i >= 0 else None for i in found] == [
+        u'Value for beta, two',
+        u'Value for alpha, one',
+        u'Value for alpha, three',
+        None,
+        u'Value for alpha, one']
+
+def test_lookup_array_same_as_multimap():
+    random.seed(0)
+    mapkeys = []
+    for i in range(30):
+        parents = random.sample(mapkeys, min(len(mapkeys), random.randint(0, 2)))
+        try:
+            mapkeys.append(MapKey(i, parents))
+        except TypeError:
+            mapkeys.append(MapKey(i))
+    m = MultiMap()
+    for i in range(40):
+        m[tuple(random.choice(mapkeys) for j in range(3))] = i
+    index = MapKeyIndex(mapkeys)
+    table = ArrayTable(m, index, 3)
+
+    keys = [tuple(random.choice(mapkeys) for j in range(3))
+            for i in range(500)]
+    found = table.lookup_array(
+        [[index.id(key[j]) for key in keys] for j in range(3)])
+    for key, i in zip(keys, found):
+        try:
+            expected = m[key]
+        except KeyError:
+            assert i == -1
+        else:
+            assert table.values[i] == expected
+
+def test_lookup_array_empty():
+    alpha = MapKey('alpha')
+    index = MapKeyIndex([alpha])
+    table = ArrayTable(MultiMap(), index, 1)
+    assert list(table.lookup_array([[0, 0]])) == [-1, -1]
+
+def test_lookup_array_wrong_arity():
+    alpha = MapKey('alpha')
+    index = MapKeyIndex([alpha])
+    table = ArrayTable(MultiMap(), index, 1)
+    with py.test.raises(ValueError):
+        table.lookup_array([[0], [0]])
+    with py.test.raises(ValueError):
+        ArrayTable(MultiMap(), index, 0)
@@ -1,5 +1,7 @@
+import py.test
+from zope.configuration.config import ConfigurationError
 import crom
-from crom import testing
+from crom import implicit, testing
 
 def setup_function(method):
     testing.setup()
@@ -31,7 +33,27 @@ def test_new_grokker():
     assert module.ITarget.providedBy(view)
     assert isinstance(view, module.View)
     assert view.context is source
-  
+
+def test_configure_two_registries():
+    from .fixtures import two_registries as module
+    crom.configure(module)
+    source = module.Source()
+    adapted = module.ITarget(source)
+    assert isinstance(adapted, module.Adapter)
+    adapted = module.ITarget(source, lookup=module.other_registry)
+    assert isinstance(adapted, module.OtherAdapter)
+    assert adapted.context is source
+
+def test_configure_bad_source():
+    from .fixtures import bad_source as module
+    with py.test.raises(ConfigurationError) as e:
+        crom.configure(module)
+    message = str(e.value)
+    assert 'BadAdapter' in message
+    assert 'Sources must either be an interface or a class.' in message
+    # the registrations before the bad one are made
+    assert implicit.registry.lookup(
+        [module.Source()], module.ITarget, 'good') is module.Adapter
     
 # XXX check the situation where a registry is passed
 # that is an IRegistry instance. Will it conflict with
@@ -1,5 +1,10 @@
+import gc
+import threading
 import py.test
-from crom import MapKey, Map, MultiMap
+from crom import (MapKey, Map, MultiMap, FlatMultiMap, FrozenMultiMap,
+                  ConcurrentMultiMap, MapKeyIndex, IndexedMap,
+                  InstrumentedMap, InstrumentedMultiMap, WeakMap,
+                  WeakMultiMap)
 
 def test_mapkey_without_parents():
     a = MapKey('a')
@@ -14,7 +19,88 @@ def test_mapkey_with_parents():
     assert c.parents == (a,)
     d = MapKey('d', [b, c])
     assert d.parents == (b, c)
+
+def test_mapkey_linearization():
+    a = MapKey('a')
+    b = MapKey('b', [a])
+    c = MapKey('c', [a])
+    d = MapKey('d', [b, c])
+    e = MapKey('e', [c])
+    f = MapKey('f', [d, e])
+    assert a._parent_mapkeys == [a]
+    assert d._parent_mapkeys == [d, b, c, a]
+    assert f._parent_mapkeys == [f, d, b, e, c, a]
+
+def test_mapkey_inconsistent_linearization():
+    a = MapKey('a')
+    b = MapKey('b', [a])
+    with py.test.raises(TypeError):
+        MapKey('c', [a, b])
     
+def test_mapkey_get_is_shared():
+    a = MapKey.get('shared a')
+    assert MapKey.get('shared a') is a
+    b = MapKey.get('shared b', [a])
+    assert MapKey.get('shared b', [a]) is b
+    assert b.parents == (a,)
+
+def test_mapkey_get_different_parents():
+    a = MapKey.get('shared a')
+    b = MapKey.get('shared b', [a])
+    with py.test.raises(ValueError):
+        MapKey.get('shared b')
+
+def test_mapkey_get_not_kept_alive():
+    a = MapKey.get('shared a')
+    del a
+    gc.collect()
+    assert 'shared a' not in MapKey._interned
+
+def test_mapkey_get_equal_to_new():
+    assert MapKey.get('shared a') == MapKey('shared a')
+
+def test_mapkey_has_no_dict():
+    a = MapKey('a')
+    with py.test.raises(AttributeError):
+        a.foo = 'bar'
+
+def test_mapkey_for_class():
+    class A(object):
+        pass
+    class B(A):
+        pass
+    class C(A):
+        pass
+    class D(B, C):
+        pass
+    d = MapKey.for_class(D)
+    assert MapKey.for_class(D) is d
+    assert d.key() is D
+    assert d.parents == (MapKey.for_class(B), MapKey.for_class(C))
+    assert [mapkey.key() for mapkey in d._parent_mapkeys] == list(D.__mro__)
+
+def test_mapkey_for_class_lookup_by_type():
+    class A(object):
+        pass
+    class B(A):
+        pass
+    m = Map()
+    m[MapKey.for_class(A)] = u'Value for A'
+    assert m[MapKey.for_class(type(B()))] == u'Value for A'
+    mm = MultiMap()
+    mm[(MapKey.for_class(A), MapKey.for_class(object))] = u'Value'
+    assert mm[(MapKey.for_class(B), MapKey.for_class(int))] == u'Value'
+
+def test_mapkey_for_class_not_kept_alive():
+    class A(object):
+        pass
+    a = MapKey.for_class(A)
+    del A
+    gc.collect()
+    assert a.key() is None
+    assert len([k for k in MapKey._classes.keys()
+                if k.__name__ == 'A']) == 0
+
 def test_map_simple_key():
     m = Map()
     a = MapKey('a')
@@ -142,6 +228,90 @@ def test_exact_get():
     assert m.exact_get(b, u'default') == u'default'
     assert m.exact_get(a) == u'Value for A'
     
+def test_mapkey_index():
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+    c = MapKey('c', parents=[a])
+    d = MapKey('d', parents=[b, c])
+
+    index = MapKeyIndex([d])
+    assert len(index) == 4
+    assert index.mapkey(index.id(b)) is b
+    assert index.is_ancestor(a, d)
+    assert index.is_ancestor(c, d)
+    assert index.is_ancestor(d, d)
+    assert not index.is_ancestor(d, a)
+    assert not index.is_ancestor(b, c)
+    # new keys are added when needed
+    e = MapKey('e', parents=[c])
+    assert index.is_ancestor(a, e)
+    assert len(index) == 5
+
+def test_mapkey_index_deep_hierarchy():
+    keys = [MapKey(0)]
+    for i in range(1, 2000):
+        keys.append(MapKey(i, [keys[-1]]))
+
+    index = MapKeyIndex([keys[-1]])
+    assert len(index) == 2000
+    assert index.is_ancestor(keys[0], keys[-1])
+    assert index.is_ancestor(keys[1000], keys[1001])
+    assert not index.is_ancestor(keys[1001], keys[1000])
+
+def test_mapkey_index_most_specific():
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+    c = MapKey('c', parents=[a])
+    d = MapKey('d', parents=[b, c])
+
+    index = MapKeyIndex()
+    bits = (1 << index.id(a)) | (1 << index.id(c)) | (1 << index.id(b))
+    assert index.most_specific(d, bits) is b
+    assert index.most_specific(c, bits) is c
+    assert index.most_specific(d, 1 << index.id(a)) is a
+    assert index.most_specific(a, 1 << index.id(d)) is None
+    assert index.in_order(d, bits) == [b, c, a]
+
+def test_indexed_map():
+    m = IndexedMap()
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+    c = MapKey('c', parents=[a])
+    d = MapKey('d', parents=[b, c])
+
+    m[c] = u'Value for C'
+    m[a] = u'Value for A'
+    assert m[d] == u'Value for C'
+    assert m[b] == u'Value for A'
+    m[b] = u'Value for B'
+    assert m[d] == u'Value for B'
+    assert m.all(d) == [u'Value for B', u'Value for C', u'Value for A']
+    assert list(m.iter_all(d, limit=1)) == [u'Value for B']
+    assert m.get(d) == u'Value for B'
+
+    del m[b]
+    assert m[d] == u'Value for C'
+    assert m.pop(c) == u'Value for C'
+    assert m[d] == u'Value for A'
+    m.clear()
+    with py.test.raises(KeyError):
+        m[d]
+    assert m.get(d) is None
+
+def test_indexed_map_shared_index():
+    index = MapKeyIndex()
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+
+    m1 = IndexedMap(index)
+    m2 = IndexedMap(index)
+    m1[a] = u'Value for A'
+    m2.update({b: u'Value for B'})
+    assert m1[b] == u'Value for A'
+    assert m2[b] == u'Value for B'
+    with py.test.raises(KeyError):
+        m2[a]
+
 def test_multimap():
     m = MultiMap()
 
@@ -200,7 +370,6 @@ def test_multimap_with_fallback():
     assert m[(alpha, two)] == u'Value for alpha, one'
     assert m[(beta, one)] == u'Value for alpha, one'
 
-@py.test.skip()
 def test_multimap_all():
     m = MultiMap()
 
@@ -225,8 +394,10 @@ def test_multimap_all():
     assert m.all((gamma, two)) == [u'Value for beta, two',
                                    u'Value for alpha, one']
     assert m.all((beta, three)) == [u'Value for beta, two',
+                                    u'Value for alpha, three',
                                     u'Value for alpha, one']
     assert m.all((gamma, three)) == [u'Value for beta, two',
+                                     u'Value for alpha, three',
                                      u'Value for alpha, one']
 
     # this uses the fallback only
@@ -234,5 +405,778 @@ def test_multimap_all():
     assert m.all((alpha, two)) == [u'Value for alpha, one']
     assert m.all((beta, one)) == [u'Value for alpha, one']
 
+def test_multimap_backtracking():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    x = MapKey('x')
+    y = MapKey('y', [x])
+
+    # (beta, two) is a prefix that matches, but there is no match for
+    # the last component under it, so the lookup has to back up
+    m[(beta, two, y)] = u'Value for beta, two, y'
+    m[(beta, one, x)] = u'Value for beta, one, x'
+    m[(alpha, two, x)] = u'Value for alpha, two, x'
+
+    assert m[(beta, two, y)] == u'Value for beta, two, y'
+    assert m[(beta, two, x)] == u'Value for beta, one, x'
+    assert m[(alpha, two, y)] == u'Value for alpha, two, x'
+    with py.test.raises(KeyError):
+        m[(alpha, one, y)]
+
+def test_multimap_no_key():
+    m = MultiMap()
+    with py.test.raises(KeyError):
+        m[()]
+    m[()] = u'Value for nothing'
+    assert m[()] == u'Value for nothing'
+
+def test_multimap_cache_invalidated_by_setitem():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(alpha, one)] = u'Value for alpha, one'
+    assert m[(beta, two)] == u'Value for alpha, one'
+    # looked up again, now from the cache
+    assert m[(beta, two)] == u'Value for alpha, one'
+
+    m[(beta, two)] = u'Value for beta, two'
+    assert m[(beta, two)] == u'Value for beta, two'
+
+def test_multimap_cache_invalidated_by_delitem():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha,)] = u'Value for alpha'
+    m[(beta,)] = u'Value for beta'
+    assert m[(beta,)] == u'Value for beta'
+
+    del m[(beta,)]
+    assert m[(beta,)] == u'Value for alpha'
+
+def test_multimap_cache_miss():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    with py.test.raises(KeyError):
+        m[(beta,)]
+    # the miss is cached
+    with py.test.raises(KeyError):
+        m[(beta,)]
+
+    m[(alpha,)] = u'Value for alpha'
+    assert m[(beta,)] == u'Value for alpha'
+
+def test_map_iter_all_limit():
+    m = Map()
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+    c = MapKey('c', parents=[a])
+    d = MapKey('d', parents=[b, c])
+
+    m[a] = u'Value for A'
+    m[b] = u'Value for B'
+    m[c] = u'Value for C'
+    assert list(m.iter_all(d)) == [u'Value for B', u'Value for C',
+                                   u'Value for A']
+    assert list(m.iter_all(d, limit=2)) == [u'Value for B', u'Value for C']
+
+def test_multimap_iter_all_limit():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, two)] = u'Value for alpha, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+
+    assert list(m.iter_all((beta, two), limit=1)) == [u'Value for beta, two']
+    assert list(m.iter_all((beta, two), limit=2)) == [u'Value for beta, two',
+                                                      u'Value for alpha, two']
+    assert list(m.iter_all((beta, two))) == [u'Value for beta, two',
+                                             u'Value for alpha, two',
+                                             u'Value for alpha, one']
+
+def test_multimap_update():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(alpha, one)] = u'Value for alpha, one'
+    assert m[(beta, two)] == u'Value for alpha, one'
+
+    m.update([((beta, two), u'Value for beta, two'),
+              ((beta,), u'Value for beta'),
+              ((), u'Value for nothing')])
+
+    assert m[(beta, two)] == u'Value for beta, two'
+    assert m[(alpha, two)] == u'Value for alpha, one'
+    assert m[(beta,)] == u'Value for beta'
+    assert m[()] == u'Value for nothing'
+
+def test_multimap_from_items():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m = MultiMap.from_items(
+        [((alpha, one), u'Value for alpha, one'),
+         ((beta, two), u'Value for beta, two')])
+
+    assert m[(beta, two)] == u'Value for beta, two'
+    assert m[(beta, one)] == u'Value for alpha, one'
+
+def test_multimap_exact_getitem():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha, alpha)] = u'Value for alpha, alpha'
+
+    assert m.exact_getitem((alpha, alpha)) == u'Value for alpha, alpha'
+    with py.test.raises(KeyError):
+        m.exact_getitem((beta, alpha))
+
+def test_multimap_exact_get():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha, alpha)] = u'Value for alpha, alpha'
+
+    assert m.exact_get((alpha, alpha)) == u'Value for alpha, alpha'
+    assert m.exact_get((beta, alpha)) is None
+    assert m.exact_get((beta, alpha), u'default') == u'default'
+
+def test_multimap_contains():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha,)] = u'Value for alpha'
+
+    assert (alpha,) in m
+    assert (beta,) not in m
+    assert (alpha, alpha) not in m
+    assert len(m) == 1
+
+    del m[(alpha,)]
+    assert (alpha,) not in m
+    assert len(m) == 0
+
+def test_multimap_delete_missing():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+
+    with py.test.raises(KeyError):
+        del m[(alpha,)]
+
+def test_multimap_freeze():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+
+    f = m.freeze()
+    assert isinstance(f, FrozenMultiMap)
+
+    assert f[(alpha, three)] == u'Value for alpha, three'
+    assert f[(beta, two)] == u'Value for beta, two'
+    assert f[(gamma, two)] == u'Value for beta, two'
+    assert f[(gamma, three)] == u'Value for beta, two'
+    assert f[(alpha, two)] == u'Value for alpha, one'
+    assert f.all((beta, three)) == [u'Value for beta, two',
+                                    u'Value for alpha, three',
+                                    u'Value for alpha, one']
+    assert f.exact_get((gamma, three)) is None
+    assert (beta, two) in f
+    with py.test.raises(KeyError):
+        f[(alpha, MapKey('other'))]
+
+    # changing the original doesn't affect the frozen copy
+    m[(gamma, three)] = u'Value for gamma, three'
+    assert f[(gamma, three)] == u'Value for beta, two'
+
+def test_frozen_multimap_is_immutable():
+    alpha = MapKey('alpha')
+
+    f = FrozenMultiMap([((alpha,), u'Value for alpha')])
+    assert f[(alpha,)] == u'Value for alpha'
+    assert f.freeze() is f
+
+    with py.test.raises(TypeError):
+        f[(alpha,)] = u'Another value'
+    with py.test.raises(TypeError):
+        del f[(alpha,)]
+    with py.test.raises(TypeError):
+        f.update([((alpha,), u'Another value')])
+    assert f[(alpha,)] == u'Value for alpha'
+
+def test_frozen_multimap_from_items():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    f = FrozenMultiMap.from_items([((alpha,), u'Value for alpha')])
+    assert f[(beta,)] == u'Value for alpha'
+
+def test_flat_multimap():
+    m = FlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+
+    assert m[(alpha, three)] == u'Value for alpha, three'
+    assert m[(beta, two)] == u'Value for beta, two'
+    assert m[(gamma, two)] == u'Value for beta, two'
+    assert m[(beta, three)] == u'Value for beta, two'
+    assert m[(gamma, three)] == u'Value for beta, two'
+    assert m[(alpha, two)] == u'Value for alpha, one'
+    assert m[(beta, one)] == u'Value for alpha, one'
+
+    assert m.all((gamma, three)) == [u'Value for beta, two',
+                                     u'Value for alpha, three',
+                                     u'Value for alpha, one']
+    with py.test.raises(KeyError):
+        m[(alpha,)]
+    with py.test.raises(KeyError):
+        m[(one, alpha)]
+
+def test_flat_multimap_backtracking():
+    m = FlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    x = MapKey('x')
+    y = MapKey('y', [x])
+
+    m[(beta, two, y)] = u'Value for beta, two, y'
+    m[(beta, one, x)] = u'Value for beta, one, x'
+    m[(alpha, two, x)] = u'Value for alpha, two, x'
+
+    assert m[(beta, two, y)] == u'Value for beta, two, y'
+    assert m[(beta, two, x)] == u'Value for beta, one, x'
+    assert m[(alpha, two, y)] == u'Value for alpha, two, x'
+    with py.test.raises(KeyError):
+        m[(alpha, one, y)]
+
+def test_flat_multimap_no_key():
+    m = FlatMultiMap()
+    with py.test.raises(KeyError):
+        m[()]
+    m[()] = u'Value for nothing'
+    assert m[()] == u'Value for nothing'
+
+def test_flat_multimap_deletion():
+    m = FlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+
+    m[(alpha, one)] = u'Value for alpha, one'
+    m[(beta, one)] = u'Value for beta, one'
+    assert m[(beta, one)] == u'Value for beta, one'
+
+    del m[(beta, one)]
+    assert m[(beta, one)] == u'Value for alpha, one'
+    assert (beta, one) not in m
+    del m[(alpha, one)]
+    with py.test.raises(KeyError):
+        m[(beta, one)]
+    with py.test.raises(KeyError):
+        del m[(alpha, one)]
+
+def test_flat_multimap_freeze():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m = FlatMultiMap.from_items([((alpha,), u'Value for alpha')])
+    assert isinstance(m, FlatMultiMap)
+    f = m.freeze()
+    assert f[(beta,)] == u'Value for alpha'
+
+def test_multimap_get_many():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+    m[()] = u'Value for nothing'
+
+    # look up one of them in advance so it's cached
+    assert m[(beta, three)] == u'Value for beta, two'
+
+    assert m.get_many([(gamma, three), (alpha, two), (beta, three),
+                       (gamma, three), (one, alpha), (), (alpha,)]) == [
+        u'Value for beta, two',
+        u'Value for alpha, one',
+        u'Value for beta, two',
+        u'Value for beta, two',
+        None,
+        u'Value for nothing',
+        None]
+    assert m.get_many([(one, alpha)], u'default') == [u'default']
+    assert m.get_many([]) == []
+
+def test_flat_multimap_get_many():
+    m = FlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m[(alpha, one)] = u'Value for alpha, one'
+
+    assert m.get_many([(gamma, three), (alpha, two), (alpha, three),
+                       (one, alpha), (one,), ()]) == [
+        u'Value for beta, two',
+        u'Value for alpha, one',
+        u'Value for alpha, three',
+        None,
+        None,
+        None]
+
+def test_multimap_all_cache_invalidated():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha,)] = u'Value for alpha'
+    assert m.all((beta,)) == [u'Value for alpha']
+
+    m[(beta,)] = u'Value for beta'
+    assert m.all((beta,)) == [u'Value for beta', u'Value for alpha']
+    assert list(m.iter_all((beta,), limit=1)) == [u'Value for beta']
+
+    del m[(alpha,)]
+    assert m.all((beta,)) == [u'Value for beta']
+
+    m.update([((alpha,), u'Value for alpha')])
+    assert m.all((beta,)) == [u'Value for beta', u'Value for alpha']
+
+def test_multimap_all_result_can_be_changed():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+
+    m[(alpha,)] = u'Value for alpha'
+    found = m.all((alpha,))
+    found.append(u'Something else')
+    assert m.all((alpha,)) == [u'Value for alpha']
+
+def count_mapkeys():
+    return len([ob for ob in gc.get_objects() if isinstance(ob, MapKey)])
+
+def test_multimap_lookup_makes_no_mapkeys():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    for m in [MultiMap(), FlatMultiMap()]:
+        m[(alpha, alpha)] = u'Value for alpha'
+        m[()] = u'Value for empty key'
+        # a MapKey is in a cycle with itself, so with the garbage
+        # collector off any MapKey made on the way is still around
+        gc.disable()
+        try:
+            before = count_mapkeys()
+            m[(beta, alpha)] = u'Value for beta'
+            for i in range(2):
+                assert m[(gamma, alpha)] == u'Value for beta'
+                assert m[(alpha, gamma)] == u'Value for alpha'
+                assert m[()] == u'Value for empty key'
+                assert m.all((gamma, gamma)) == [u'Value for beta',
+                                                 u'Value for alpha']
+            after = count_mapkeys()
+        finally:
+            gc.enable()
+        assert after == before
+
+def test_concurrent_multimap():
+    m = ConcurrentMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m[(alpha, three)] = u'Value for alpha, three'
+    m[(beta, two)] = u'Value for beta, two'
+    m.update([((alpha, one), u'Value for alpha, one'),
+              ((), u'Value for nothing')])
+
+    assert m[(gamma, three)] == u'Value for beta, two'
+    assert m[(alpha, two)] == u'Value for alpha, one'
+    assert m[()] == u'Value for nothing'
+    assert m.all((beta, three)) == [u'Value for beta, two',
+                                    u'Value for alpha, three',
+                                    u'Value for alpha, one']
+    assert m.get_many([(gamma, three), (one,)]) == [
+        u'Value for beta, two', None]
+    assert m.exact_get((beta, two)) == u'Value for beta, two'
+    assert (gamma, three) not in m
+    assert len(m) == 4
+
+    del m[(beta, two)]
+    assert m[(gamma, three)] == u'Value for alpha, three'
+    with py.test.raises(KeyError):
+        del m[(beta, two)]
+    assert len(m) == 3
+
+def test_concurrent_multimap_snapshot():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m = ConcurrentMultiMap.from_items([
+        ((alpha, one), u'Value for alpha, one')])
+    snapshot = m.snapshot()
+
+    m[(alpha, two)] = u'Value for alpha, two'
+    m[(beta, two)] = u'Value for beta, two'
+    del m[(alpha, one)]
+
+    assert m[(beta, two)] == u'Value for beta, two'
+    assert snapshot[(beta, two)] == u'Value for alpha, one'
+    assert len(snapshot) == 1
+    # the path to (alpha, one) was copied before deleting from it
+    assert snapshot.exact_get((alpha, one)) == u'Value for alpha, one'
+    assert snapshot.all((alpha, two)) == [u'Value for alpha, one']
+
+def test_concurrent_multimap_snapshot_cannot_be_changed():
+    alpha = MapKey('alpha')
+    m = ConcurrentMultiMap.from_items([((alpha,), u'Value for alpha')])
+    snapshot = m.snapshot()
+    with py.test.raises(TypeError):
+        snapshot[(alpha,)] = u'Other value'
+    with py.test.raises(TypeError):
+        del snapshot[(alpha,)]
+    with py.test.raises(TypeError):
+        snapshot.update([((alpha,), u'Other value')])
+    assert m[(alpha,)] == u'Value for alpha'
+
+def test_concurrent_multimap_threads():
+    m = ConcurrentMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m.update([((alpha, one), 0), ((alpha, two), 0)])
+
+    errors = []
+    done = []
+
+    def read():
+        while not done:
+            # the values found for both keys are always the same in a
+            # consistent version
+            first, second = m.get_many([(beta, one), (beta, two)])
+            if first != second:
+                errors.append((first, second))
+            snapshot = m.snapshot()
+            if snapshot[(beta, one)] != snapshot[(beta, two)]:
+                errors.append(snapshot)
+
+    def write():
+        for i in range(1, 1000):
+            m.update([((alpha, one), i), ((alpha, two), i)])
+            m.update([((beta, one), i), ((beta, two), i)])
+            del m[(beta, one)]
+            del m[(beta, two)]
+
+    readers = [threading.Thread(target=read) for i in range(4)]
+    writer = threading.Thread(target=write)
+    for thread in readers:
+        thread.start()
+    writer.start()
+    writer.join()
+    done.append(True)
+    for thread in readers:
+        thread.join()
+    assert not errors
+
+def test_multimap_deletion():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(alpha, one)] = u'Value for alpha, one'
+    m[(beta, two)] = u'Value for beta, two'
+    assert m.stats() == {'entries': 2, 'nodes': 3, 'depth': 2}
+
+    del m[(beta, two)]
+    assert m[(beta, two)] == u'Value for alpha, one'
+    # the Map for beta is gone
+    assert m.stats() == {'entries': 1, 'nodes': 2, 'depth': 2}
+
+    del m[(alpha, one)]
+    with py.test.raises(KeyError):
+        m[(beta, two)]
+    assert m.stats() == {'entries': 0, 'nodes': 0, 'depth': 0}
+
+def test_multimap_compact():
+    m = MultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(alpha, one)] = u'Value for alpha, one'
+    m[(beta, two)] = u'Value for beta, two'
+    m[()] = u'Value for nothing'
+    keys = [MapKey(i) for i in range(100)]
+    for key in keys:
+        m[(key, key)] = key
+    for key in keys:
+        del m[(key, key)]
+
+    m.compact()
+    assert m.stats() == {'entries': 3, 'nodes': 3, 'depth': 2}
+    assert m[(beta, two)] == u'Value for beta, two'
+    assert m[(beta, one)] == u'Value for alpha, one'
+    assert m[()] == u'Value for nothing'
+
+def test_flat_multimap_compact():
+    m = FlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha,)] = u'Value for alpha'
+    m[(alpha, beta)] = u'Value for alpha, beta'
+    assert m.stats() == {'entries': 2, 'nodes': 3, 'depth': 1}
+    del m[(alpha, beta)]
+    assert m.stats() == {'entries': 1, 'nodes': 1, 'depth': 1}
+    m.compact()
+    assert m.stats() == {'entries': 1, 'nodes': 1, 'depth': 1}
+    assert m[(beta,)] == u'Value for alpha'
+
+def test_concurrent_multimap_deletion():
+    m = ConcurrentMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha, alpha)] = u'Value for alpha, alpha'
+    m[(beta, beta)] = u'Value for beta, beta'
+    snapshot = m.snapshot()
+    assert m.stats() == {'entries': 2, 'nodes': 3, 'depth': 2}
+
+    del m[(beta, beta)]
+    assert m.stats() == {'entries': 1, 'nodes': 2, 'depth': 2}
+    assert snapshot.stats() == {'entries': 2, 'nodes': 3, 'depth': 2}
+    m.compact()
+    assert m[(beta, beta)] == u'Value for alpha, alpha'
+    assert snapshot[(beta, beta)] == u'Value for beta, beta'
+
+def test_instrumented_map():
+    m = InstrumentedMap()
+    a = MapKey('a')
+    b = MapKey('b', parents=[a])
+    c = MapKey('c', parents=[a])
+    d = MapKey('d', parents=[b, c])
+
+    m[c] = u'Value for C'
+    assert m[d] == u'Value for C'
+    assert m[c] == u'Value for C'
+    assert m.get(a) is None
+    with py.test.raises(KeyError):
+        m[b]
+
+    assert m.stats.lookups == 4
+    assert m.stats.hits == 2
+    assert m.stats.misses == 2
+    assert m.stats.positions == {0: 1, 2: 1}
+
+    m.stats.reset()
+    assert m.stats.lookups == 0
+    assert m.stats.positions == {}
+
+def test_instrumented_multimap():
+    m = InstrumentedMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+
+    m[(beta, one)] = u'Value for beta, one'
+
+    assert m[(gamma, two)] == u'Value for beta, one'
+    assert m[(gamma, two)] == u'Value for beta, one'
+    assert m[(beta, one)] == u'Value for beta, one'
+    with py.test.raises(KeyError):
+        m[(alpha, one)]
+
+    assert m.stats.lookups == 4
+    assert m.stats.hits == 3
+    assert m.stats.misses == 1
+    assert m.stats.positions == {(1, 1): 2, (0, 0): 1}
+
+    # positions are forgotten when the map changes
+    m[(gamma, two)] = u'Value for gamma, two'
+    assert m[(gamma, two)] == u'Value for gamma, two'
+    assert m.stats.positions == {(1, 1): 2, (0, 0): 2}
+
+def test_instrumented_flat_multimap():
+    class InstrumentedFlatMultiMap(InstrumentedMultiMap, FlatMultiMap):
+        pass
+
+    m = InstrumentedFlatMultiMap()
+
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m[(alpha,)] = u'Value for alpha'
+    assert m[(beta,)] == u'Value for alpha'
+    assert m.stats.positions == {(1,): 1}
+
+def test_weak_map():
+    m = WeakMap()
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    m[alpha] = u'Value for alpha'
+    assert m[beta] == u'Value for alpha'
+    assert m[MapKey('alpha')] == u'Value for alpha'
+    assert list(m) == [alpha]
+    assert m.items() == [(alpha, u'Value for alpha')]
+    m[MapKey('alpha')] = u'New value for alpha'
+    assert m[beta] == u'New value for alpha'
+    assert len(m) == 1
+    del beta
+    del alpha
+    gc.collect()
+    assert len(m) == 0
+
+def test_weak_multimap():
+    m = WeakMultiMap()
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    one = MapKey('one')
+    m[(alpha, one)] = u'Value for alpha, one'
+    assert m[(beta, one)] == u'Value for alpha, one'
+    assert m.all((beta, one)) == [u'Value for alpha, one']
+    assert (alpha, one) in m
+    assert m.freeze()[(beta, one)] == u'Value for alpha, one'
+    del m[(alpha, one)]
+    with py.test.raises(KeyError):
+        m[(beta, one)]
+    m[(alpha, one)] = u'Value for alpha, one'
+    del one
+    gc.collect()
+    assert len(m) == 0
+    assert len(m._cache) == 0
+    assert len(m._all_cache) == 0
 
-# XXX test_multimap_deletion
+def test_weak_multimap_memory_stays_flat():
+    class Base(object):
+        pass
+    base = MapKey.for_class(Base)
+    parent = MapKey.get('parent')
+    m = WeakMap()
+    mm = WeakMultiMap()
+    mm[(base, parent)] = u'Value for base'
+    def cycle(i):
+        tenant = MapKey.for_class(type('Tenant', (Base,), {}))
+        key = MapKey.get(('request', i), [parent])
+        m[key] = i
+        mm[(tenant, key)] = i
+        assert mm[(tenant, key)] == i
+        assert mm[(tenant, parent)] == u'Value for base'
+        assert mm.get_many([(tenant, key)]) == [i]
+    for i in range(10000):
+        cycle(i)
+    # MapKeys for classes can only go after their classes have gone
+    gc.collect()
+    gc.collect()
+    assert len(m) == 0
+    assert len(mm) == 1
+    assert len(mm._cache) == 0
+    assert mm.stats()['entries'] == 1
+    assert mm.stats()['nodes'] == 2
+    assert not [key for key in MapKey._interned.keys()
+                if isinstance(key, tuple) and key[0] == 'request']
+    assert not [cls for cls in MapKey._classes.keys()
+                if cls.__name__ == 'Tenant']
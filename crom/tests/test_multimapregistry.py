@@ -0,0 +1,227 @@
+import gc
+import random
+import weakref
+import py.test
+from zope.interface import directlyProvides, classImplements
+from crom.registry import Registry, MultiMapRegistry
+from crom import Interface, implements, implicit, ComponentLookupError
+from crom import monkey
+
+class IAlpha(Interface):
+    pass
+
+@implements(IAlpha)
+class Alpha(object):
+    pass
+
+class IBeta(Interface):
+    pass
+
+@implements(IBeta)
+class Beta(object):
+    pass
+
+class ITarget(Interface):
+    pass
+
+class ISubTarget(ITarget):
+    pass
+
+class IOtherSubTarget(ITarget):
+    pass
+
+class ISubSubTarget(ISubTarget):
+    pass
+
+def compare_backends(registrations, lookups):
+    # make the same registrations with Registry and MultiMapRegistry,
+    # and check that lookups find the same components after each
+    reg = Registry()
+    mmreg = MultiMapRegistry()
+    for registration in registrations:
+        reg.register(*registration)
+        mmreg.register(*registration)
+        for obs, target, name in lookups:
+            assert (mmreg.lookup(obs, target, name) is
+                    reg.lookup(obs, target, name)), registration
+
+def setup_function(method):
+    monkey.incompat()
+
+def teardown_function(method):
+    monkey.revert_incompat()
+
+def test_component_no_source():
+    reg = MultiMapRegistry()
+    foo = object()
+    reg.register((), ITarget, '', foo)
+    assert reg.lookup([], ITarget, '') is foo
+    assert ITarget.component(lookup=reg) is foo
+
+def test_component_sources():
+    reg = MultiMapRegistry()
+    foo = object()
+    bar = object()
+    reg.register((IAlpha,), ITarget, '', foo)
+    reg.register((IAlpha, IBeta), ITarget, '', bar)
+    alpha = Alpha()
+    beta = Beta()
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg.lookup([alpha, beta], ITarget, '') is bar
+    assert reg.lookup([beta, alpha], ITarget, '') is None
+    assert reg.lookup([beta], ITarget, '') is None
+
+def test_component_inheritance():
+    reg = MultiMapRegistry()
+    foo = object()
+    bar = object()
+
+    class Gamma(object):
+        pass
+
+    @implements(IAlpha)
+    class Delta(Gamma):
+        pass
+
+    reg.register([Gamma], ITarget, '', foo)
+    assert reg.lookup([Delta()], ITarget, '') is foo
+    # the interface of a class is more specific than its base class
+    reg.register([IAlpha], ITarget, '', bar)
+    assert reg.lookup([Delta()], ITarget, '') is bar
+    reg.register([Delta], ITarget, '', foo)
+    assert reg.lookup([Delta()], ITarget, '') is foo
+
+def test_component_extended_target():
+    reg = MultiMapRegistry()
+    foo = object()
+    bar = object()
+    reg.register([IAlpha], ISubTarget, '', foo)
+    assert reg.lookup([Alpha()], ITarget, '') is foo
+    assert reg.lookup([Alpha()], ISubTarget, '') is foo
+    reg.register([IAlpha], ITarget, '', bar)
+    assert reg.lookup([Alpha()], ITarget, '') is bar
+    assert reg.lookup([Alpha()], ISubTarget, '') is foo
+
+def test_component_directly_provided():
+    reg = MultiMapRegistry()
+    foo = object()
+    reg.register([IBeta], ITarget, '', foo)
+    alpha = Alpha()
+    directlyProvides(alpha, IBeta)
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg.lookup([Alpha()], ITarget, '') is None
+
+def test_name():
+    reg = MultiMapRegistry()
+    foo = object()
+    reg.register([Alpha], ITarget, 'x', foo)
+    alpha = Alpha()
+    assert ITarget.component(alpha, lookup=reg, name='x') is foo
+    assert ITarget.component(alpha, lookup=reg, default=None) is None
+
+def test_unregister():
+    reg = MultiMapRegistry()
+    foo = object()
+    reg.register([Alpha], ITarget, '', foo)
+    reg.register([Alpha], ITarget, '', None)
+    assert reg.lookup([Alpha()], ITarget, '') is None
+
+def test_register_wrong_source():
+    reg = MultiMapRegistry()
+    with py.test.raises(TypeError):
+        reg.register([object()], ITarget, '', object())
+
+def test_register_many():
+    reg = MultiMapRegistry()
+    foo = object()
+    bar = object()
+    reg.register_many([
+        ([IAlpha], ITarget, '', foo),
+        ([IAlpha], ITarget, 'x', bar),
+        ])
+    assert reg.lookup([Alpha()], ITarget, '') is foo
+    assert reg.lookup([Alpha()], ITarget, 'x') is bar
+
+def test_adapt():
+    reg = MultiMapRegistry()
+
+    @implements(ITarget)
+    class Adapted(object):
+        def __init__(self, context):
+            self.context = context
+
+    reg.register([IAlpha], ITarget, '', Adapted)
+    alpha = Alpha()
+    adapted = ITarget(alpha, lookup=reg)
+    assert isinstance(adapted, Adapted)
+    assert adapted.context is alpha
+    adapted_many = ITarget.adapt_many([alpha, adapted], lookup=reg)
+    assert adapted_many[0].context is alpha
+    assert adapted_many[1] is adapted
+    with py.test.raises(ComponentLookupError):
+        ITarget(Beta(), lookup=reg)
+
+def test_implicit():
+    reg = MultiMapRegistry()
+    implicit.initialize_with_registry(reg)
+    try:
+        foo = object()
+        reg.register([IAlpha], ITarget, '', foo)
+        assert ITarget.component(Alpha()) is foo
+    finally:
+        implicit.clear()
+
+def test_unregister_extended_target_same_as_registry():
+    registrations = [
+        ([], IOtherSubTarget, '', None),
+        ([], ISubTarget, '', 'A'),
+        ([], IOtherSubTarget, '', 'B'),
+        ([], ISubTarget, '', None),
+        ([], ISubTarget, '', 'A'),
+        ]
+    compare_backends(registrations, [([], ITarget, '')])
+    reg = MultiMapRegistry()
+    for registration in registrations[:3]:
+        reg.register(*registration)
+    assert reg.lookup([], ITarget, '') == 'B'
+
+def test_register_and_unregister_same_as_registry():
+    targets = [ITarget, ISubTarget, IOtherSubTarget, ISubSubTarget]
+    sources = [[], [IAlpha], [Alpha], [IAlpha, IBeta]]
+    components = [None, None, 'a', 'b', 'c']
+    lookups = [(obs, target, name)
+               for obs in [[], [Alpha()], [Alpha(), Beta()]]
+               for target in targets for name in ['', 'x']]
+    for seed in range(20):
+        rng = random.Random(seed)
+        registrations = [(rng.choice(sources), rng.choice(targets),
+                          rng.choice(['', 'x']), rng.choice(components))
+                         for i in range(30)]
+        compare_backends(registrations, lookups)
+
+def test_changed_declarations_picked_up_after_register():
+    for reg in [Registry(), MultiMapRegistry()]:
+        class Gamma(object):
+            pass
+        gamma = Gamma()
+        foo = object()
+        reg.register([IBeta], ITarget, '', foo)
+        assert reg.lookup([gamma], ITarget, '') is None
+        classImplements(Gamma, IBeta)
+        reg.register([IAlpha], ITarget, 'other', object())
+        assert reg.lookup([gamma], ITarget, '') is foo
+
+def test_looked_up_classes_not_kept_after_register():
+    reg = MultiMapRegistry()
+    foo = object()
+    reg.register([IAlpha], ITarget, '', foo)
+    class Gamma(Alpha):
+        pass
+    assert reg.lookup([Gamma()], ITarget, '') is foo
+    ref = weakref.ref(Gamma)
+    del Gamma
+    reg.register([IBeta], ITarget, '', object())
+    gc.collect()
+    gc.collect()
+    assert ref() is None
+    assert reg.lookup([Alpha()], ITarget, '') is foo
@@ -1,7 +1,9 @@
 import py.test
-from crom.registry import Registry
+from crom.registry import Registry, MultiMapRegistry
+from crom.lookup import ListLookup, ChainLookup
 from crom import Interface, implements, ComponentLookupError
 from crom import monkey
+from zope.interface import directlyProvides
 
 class IAlpha(Interface):
     pass
@@ -230,3 +232,206 @@ def test_extra_kw():
     with py.test.raises(TypeError) as e:
         ITarget.component(alpha, lookup=reg, extra="illegal")
     assert str(e.value) == 'Illegal extra keyword arguments: extra'
+
+def test_lookup_cached_by_class():
+    reg = Registry()
+    foo = object()
+    reg.register([IAlpha], ITarget, '', foo)
+    alpha = Alpha()
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg._class_cache == {((Alpha,), ITarget, ''): foo}
+    assert reg.lookup([Alpha()], ITarget, '') is foo
+    assert reg.lookup([alpha], ITarget, 'x') is None
+    assert reg._class_cache[((Alpha,), ITarget, 'x')] is None
+
+def test_lookup_cache_cleared_on_register():
+    reg = Registry()
+    foo = object()
+    bar = object()
+    alpha = Alpha()
+    assert reg.lookup([alpha], ITarget, '') is None
+    reg.register([IAlpha], ITarget, '', foo)
+    assert reg.lookup([alpha], ITarget, '') is foo
+    reg.register([Alpha], ITarget, '', bar)
+    assert reg.lookup([alpha], ITarget, '') is bar
+
+def test_lookup_directly_provided_not_cached():
+    reg = Registry()
+    foo = object()
+    bar = object()
+    reg.register([IAlpha], ITarget, '', foo)
+    reg.register([IBeta], ITarget, '', bar)
+    alpha = Alpha()
+    other = Alpha()
+    directlyProvides(other, IBeta)
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg.lookup([other], ITarget, '') is bar
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg._class_cache == {((Alpha,), ITarget, ''): foo}
+
+def test_register_many():
+    reg = Registry()
+    foo = object()
+    bar = object()
+    alpha = Alpha()
+    assert reg.lookup([alpha], ITarget, '') is None
+    reg.register_many([
+        ([IAlpha], ITarget, '', foo),
+        ([Alpha, IBeta], ITarget, 'x', bar),
+        ])
+    assert reg.lookup([alpha], ITarget, '') is foo
+    assert reg.lookup([alpha, Beta()], ITarget, 'x') is bar
+    # the registry still reacts to changes afterwards
+    reg.register([Alpha], ITarget, '', bar)
+    assert reg.lookup([alpha], ITarget, '') is bar
+
+def test_register_many_checks_all_first():
+    reg = Registry()
+    foo = object()
+    with py.test.raises(TypeError):
+        reg.register_many([
+            ([IAlpha], ITarget, '', foo),
+            ([object()], ITarget, '', foo),
+            ])
+    assert reg.lookup([Alpha()], ITarget, '') is None
+
+def test_adapt_many():
+    reg = Registry()
+
+    @implements(ITarget)
+    class Adapted(object):
+        def __init__(self, context):
+            self.context = context
+
+    reg.register([IAlpha], ITarget, '', Adapted)
+    obs = [Alpha(), Alpha(), Beta(), Adapted(None)]
+    adapted = list(reg.adapt_many(obs, ITarget, ''))
+    assert len(adapted) == 4
+    assert isinstance(adapted[0], Adapted)
+    assert adapted[0].context is obs[0]
+    assert adapted[1].context is obs[1]
+    assert adapted[2] is None
+    assert adapted[3] is obs[3]
+
+def test_adapt_many_looks_up_once_per_class():
+    reg = Registry()
+    looked_up = []
+    lookup = reg.lookup
+    def counting_lookup(obs, target, name):
+        looked_up.append(obs)
+        return lookup(obs, target, name)
+    reg.lookup = counting_lookup
+    reg.register([IAlpha], ITarget, '', lambda context: context)
+    obs = [Alpha() for i in range(10)] + [Beta() for i in range(10)]
+    assert list(reg.adapt_many(obs, ITarget, '')) == obs[:10] + [None] * 10
+    assert len(looked_up) == 2
+
+def test_adapt_many_directly_provided():
+    reg = Registry()
+    reg.register([IAlpha], ITarget, '', lambda context: 'alpha')
+    reg.register([IBeta], ITarget, '', lambda context: 'beta')
+    other = Alpha()
+    directlyProvides(other, IBeta)
+    obs = [Alpha(), other, Alpha()]
+    assert list(reg.adapt_many(obs, ITarget, '')) == ['alpha', 'beta',
+                                                     'alpha']
+
+def test_interface_adapt_many():
+    reg = Registry()
+    reg.register([IAlpha], ITarget, '', lambda context: 'alpha')
+    reg.register([IAlpha], ITarget, 'x', lambda context: 'x')
+    alpha = Alpha()
+    assert ITarget.adapt_many([alpha, alpha], lookup=reg) == ['alpha',
+                                                             'alpha']
+    assert ITarget.adapt_many([alpha], lookup=reg, name='x') == ['x']
+    assert ITarget.adapt_many([alpha, Beta()], lookup=reg,
+                              default=None) == ['alpha', None]
+    with py.test.raises(ComponentLookupError):
+        ITarget.adapt_many([alpha, Beta()], lookup=reg)
+
+def test_interface_adapt_many_stream():
+    reg = Registry()
+    reg.register([IAlpha], ITarget, '', lambda context: 'alpha')
+    def obs():
+        yield Alpha()
+        yield Beta()
+    adapted = ITarget.adapt_many(obs(), lookup=reg, stream=True)
+    assert next(adapted) == 'alpha'
+    with py.test.raises(ComponentLookupError):
+        next(adapted)
+
+def test_freeze():
+    reg = Registry()
+    foo = object()
+    bar = object()
+    reg.register([IAlpha], ITarget, '', foo)
+    reg.register([IBeta], ITarget, '', bar)
+    frozen = reg.freeze()
+    assert frozen.freeze() is frozen
+    alpha = Alpha()
+    other = Alpha()
+    directlyProvides(other, IBeta)
+    assert frozen.lookup([alpha], ITarget, '') is foo
+    assert frozen.lookup([other], ITarget, '') is bar
+    assert frozen.lookup([Beta()], ITarget, 'x') is None
+    assert ITarget.component(alpha, lookup=frozen) is foo
+    # entries are remembered
+    assert frozen._dispatch[((Alpha,), ITarget, '')] is foo
+    assert frozen.lookup([alpha], ITarget, '') is foo
+
+def test_freeze_adapt():
+    for reg in [Registry(), MultiMapRegistry()]:
+        reg.register([IAlpha], ITarget, '', lambda context: 'alpha')
+        frozen = reg.freeze()
+        alpha = Alpha()
+        assert ITarget(alpha, lookup=frozen) == 'alpha'
+        assert ITarget.adapt_many([alpha], lookup=frozen) == ['alpha']
+
+def test_freeze_rejects_register():
+    for reg in [Registry(), MultiMapRegistry()]:
+        frozen = reg.freeze()
+        for r in [reg, frozen]:
+            with py.test.raises(TypeError):
+                r.register([IAlpha], ITarget, '', object())
+            with py.test.raises(TypeError):
+                r.register_many([([IAlpha], ITarget, '', object())])
+
+def test_list_lookup():
+    first = Registry()
+    second = Registry()
+    foo = object()
+    bar = object()
+    first.register([IAlpha], ITarget, '', foo)
+    second.register([IAlpha], ITarget, '', bar)
+    second.register([IBeta], ITarget, '', bar)
+    lookup = ListLookup([first, second])
+    assert lookup.lookup([Alpha()], ITarget, '') is foo
+    assert lookup.lookup([Beta()], ITarget, '') is bar
+    assert lookup.lookup([Beta()], ITarget, 'x') is None
+
+def test_list_lookup_adapt_many():
+    first = Registry()
+    second = Registry()
+    first.register([IAlpha], ITarget, '', lambda context: 'first')
+    second.register([IBeta], ITarget, '', lambda context: 'second')
+    lookup = ListLookup([first, second])
+    alpha = Alpha()
+    assert lookup.adapt([alpha], ITarget, '') == 'first'
+    assert list(lookup.adapt_many([alpha, Beta(), object()],
+                                  ITarget, '')) == ['first', 'second', None]
+
+def test_chain_lookup_adapt_many():
+    first = Registry()
+    second = Registry()
+    first.register([IAlpha], ITarget, '', lambda context: 'first')
+    second.register([IAlpha], ITarget, '', lambda context: 'second')
+    second.register([IBeta], ITarget, '', lambda context: 'second')
+    lookup = ChainLookup(first, second)
+    def obs():
+        yield Alpha()
+        yield Beta()
+        yield object()
+    assert list(lookup.adapt_many(obs(), ITarget, '')) == [
+        'first', 'second', None]
+    assert ITarget.adapt_many([Beta(), Alpha()], lookup=lookup) == [
+        'second', 'first']
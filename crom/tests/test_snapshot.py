@@ -0,0 +1,129 @@
+import io
+import py.test
+from crom import MapKey, MultiMap, FlatMultiMap, FrozenMultiMap
+from crom import snapshot
+
+def value_for_alpha():
+    pass
+
+def value_for_beta_two():
+    pass
+
+class ValueForNothing(object):
+    pass
+
+def test_dump_load():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+    gamma = MapKey('gamma', [beta])
+
+    one = MapKey('one')
+    two = MapKey('two', [one])
+    three = MapKey('three', [two])
+
+    m = MultiMap()
+    m[(alpha, one)] = value_for_alpha
+    m[(beta, two)] = value_for_beta_two
+    m[()] = ValueForNothing
+
+    f = io.BytesIO()
+    snapshot.dump(m, f)
+    f.seek(0)
+    loaded = snapshot.load(f)
+
+    assert type(loaded) is MultiMap
+    assert len(loaded) == 3
+    assert loaded[(alpha, one)] is value_for_alpha
+    assert loaded[(gamma, three)] is value_for_beta_two
+    assert loaded[(beta, one)] is value_for_alpha
+    assert loaded[()] is ValueForNothing
+    with py.test.raises(KeyError):
+        loaded[(one, alpha)]
+
+def test_load_restores_mapkeys():
+    a = MapKey('a')
+    b = MapKey('b', [a])
+    c = MapKey('c', [a])
+    d = MapKey('d', [b, c])
+
+    m = MultiMap()
+    m[(d,)] = value_for_alpha
+
+    f = io.BytesIO()
+    snapshot.dump(m, f)
+    f.seek(0)
+    loaded = snapshot.load(f, FlatMultiMap)
+
+    assert type(loaded) is FlatMultiMap
+    [(loaded_d,)] = loaded._exact.keys()
+    assert loaded_d is not d
+    assert loaded_d == d
+    assert [k.key for k in loaded_d.parents] == ['b', 'c']
+    assert ([k.key for k in loaded_d._parent_mapkeys] ==
+            ['d', 'b', 'c', 'a'])
+
+def test_load_frozen():
+    alpha = MapKey('alpha')
+    beta = MapKey('beta', [alpha])
+
+    m = MultiMap()
+    m[(alpha,)] = value_for_alpha
+    m[()] = ValueForNothing
+
+    f = io.BytesIO()
+    snapshot.dump(m, f)
+    f.seek(0)
+    loaded = snapshot.load(f, FrozenMultiMap)
+
+    assert type(loaded) is FrozenMultiMap
+    assert loaded[(beta,)] is value_for_alpha
+    assert loaded[()] is ValueForNothing
+
+def test_dump_load_deep_hierarchy():
+    keys = [MapKey(('deep', 0))]
+    for i in range(1, 1500):
+        keys.append(MapKey(('deep', i), [keys[-1]]))
+
+    m = MultiMap()
+    m[(keys[0],)] = value_for_alpha
+    m[(keys[-1],)] = value_for_beta_two
+
+    f = io.BytesIO()
+    snapshot.dump(m, f)
+    f.seek(0)
+    loaded = snapshot.load(f)
+
+    assert loaded[(keys[-1],)] is value_for_beta_two
+    assert loaded[(keys[1000],)] is value_for_alpha
+
+def test_dump_value_without_dotted_name():
+    alpha = MapKey('alpha')
+    m = MultiMap()
+    m[(alpha,)] = object()
+    with py.test.raises(ValueError):
+        snapshot.dump(m, io.BytesIO())
+
+def test_load_not_a_snapshot():
+    import marshal
+    f = io.BytesIO(marshal.dumps(('something else',)))
+    with py.test.raises(ValueError):
+        snapshot.load(f)
+
+def test_load_other_python_version():
+    import marshal
+    header = snapshot._header()
+    data = header[:3] + ((2, 5), [], [], [])
+    f = io.BytesIO(marshal.dumps(data))
+    with py.test.raises(ValueError) as e:
+        snapshot.load(f)
+    assert 'Python 2.5' in str(e.value)
+    data = header[:2] + (-1,) + header[3:] + ([], [], [])
+    f = io.BytesIO(marshal.dumps(data))
+    with py.test.raises(ValueError):
+        snapshot.load(f)
+
+def test_resolve():
+    assert snapshot.resolve('crom.snapshot.resolve') is snapshot.resolve
+    assert snapshot.resolve('crom.tests.test_snapshot') is not None
+    with py.test.raises(ImportError):
+        snapshot.resolve('crom.tests.nonexistent')
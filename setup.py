@@ -17,6 +17,7 @@ setup(name='crom',
                         'grokker'],
       extras_require = dict(
         test=['pytest >= 2.0'],
+        numpy=['numpy'],
         ),
       entry_points="""
       # Add entry points here